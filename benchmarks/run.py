@@ -0,0 +1,190 @@
+#!/usr/bin/env python3
+'''Measures how long kostka commands take on hosts with many containers.
+
+Everything happens in a temporary root directory: containers, units, the
+image store and an image hub served over HTTP from the same process.
+systemctl and machinectl are replaced by the stubs in benchmarks/stubs, so
+no systemd (and no root) is needed, and the numbers are kostka's own cost.
+
+    python3 benchmarks/run.py --sizes 10,100,1000 --output results.json
+'''
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import threading
+import time
+from datetime import datetime, timezone
+from functools import partial
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from tempfile import mkdtemp
+import click
+
+REPO = Path(__file__).resolve().parent.parent
+STUBS = REPO / 'benchmarks' / 'stubs'
+
+
+class QuietHandler(SimpleHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+
+def serve(directory):
+    '''Serves directory over HTTP in a background thread, returns its URL'''
+    server = ThreadingHTTPServer(('127.0.0.1', 0), partial(QuietHandler, directory=str(directory)))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, 'http://127.0.0.1:{}'.format(server.server_address[1])
+
+
+class Host:
+    '''A kostka installation inside root'''
+    def __init__(self, root, hub_url):
+        self.root = root
+        store = root / 'kostka'
+        self.config = {
+            'machines_dir': str(root / 'machines'),
+            'unit_dir': str(root / 'units'),
+            'systemctl': str(STUBS / 'systemctl'),
+            'machinectl': str(STUBS / 'machinectl'),
+            'systemd_backend': 'subprocess',
+            'hook_dirs': [],
+            'image_hub': hub_url,
+            'image_root': str(store / 'images'),
+            'blob_root': str(store / 'blobs'),
+            'layer_root': str(store / 'layers'),
+            'layer_cache': str(store / 'layer-cache.json'),
+            'squash_root': str(store / 'squashed'),
+            'metadata_index': str(store / 'index.sqlite'),
+            'lock_path': str(store / 'lock'),
+            'container_inventory': str(store / 'containers.json'),
+            'lowerdir_cache': str(store / 'lowerdirs.json'),
+            'container_graph': str(store / 'graph.json'),
+            'plugin_cache': str(store / 'entry-points.json'),
+            'hub_cache': str(store / 'hub-cache.json'),
+        }
+        for key in ('machines_dir', 'unit_dir', 'image_root', 'blob_root', 'layer_root'):
+            os.makedirs(self.config[key], exist_ok=True)
+
+        # JSON is valid YAML
+        with (root / 'kostka.yml').open('w') as f:
+            f.write(json.dumps(self.config, indent=2))
+        self.env = dict(os.environ, KOSTKA_CONFIG=str(root / 'kostka.yml'), PYTHONPATH=str(REPO))
+
+    def kostka(self, *args):
+        cmd = [sys.executable, '-m', 'kostka.kostka'] + list(args)
+        result = subprocess.run(cmd, env=self.env, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+        if result.returncode != 0:
+            sys.stderr.write(result.stderr.decode('utf-8', 'replace'))
+            raise subprocess.CalledProcessError(result.returncode, cmd)
+
+    def template(self, name, files):
+        '''Creates a container with files in its overlay, without using kostka'''
+        path = self.root / 'machines' / name
+        overlay = path / 'overlay.fs-1'
+        for i in range(files):
+            directory = overlay / 'usr' / 'share' / 'd{}'.format(i % 50)
+            directory.mkdir(parents=True, exist_ok=True)
+            (directory / 'f{}'.format(i)).write_bytes(os.urandom(4096))
+        (path / 'overlay.fs').symlink_to(overlay)
+        (path / 'manifest').write_text(json.dumps({'name': name, 'dependencies': []}))
+
+    def publish(self, hub, name, version):
+        '''Copies an image from the local store to the hub directory'''
+        image = hub / 'images' / name / version
+        image.mkdir(parents=True)
+        shutil.copy(os.path.join(self.config['image_root'], name, version, 'index.json'), str(image))
+        shutil.copytree(self.config['blob_root'], str(hub / 'blobs'), dirs_exist_ok=True)
+
+    def clear_store(self):
+        for key in ('image_root', 'blob_root', 'layer_root'):
+            shutil.rmtree(self.config[key])
+            os.makedirs(self.config[key])
+        for key in ('metadata_index', 'layer_cache'):
+            for suffix in ('', '-wal', '-shm'):
+                try:
+                    os.unlink(self.config[key] + suffix)
+                except FileNotFoundError:
+                    pass
+
+
+def benchmark(root, size, files, report):
+    hub = root / 'hub'
+    hub.mkdir(parents=True)
+    server, url = serve(hub)
+    try:
+        host = Host(root / 'host', url)
+
+        def measure(operation, *commands):
+            start = time.monotonic()
+            for args in commands:
+                host.kostka(*args)
+            report(size, operation, time.monotonic() - start, len(commands))
+
+        host.template('base-src', files)
+        measure('image create', ['image', 'create', 'base-src', 'base:1.0'])
+        host.publish(hub, 'base', '1.0')
+        host.clear_store()
+        measure('image download', ['image', 'download', 'base:1.0'])
+
+        # One container using the image, all others using that container
+        names = ['c{}'.format(i) for i in range(size)]
+        measure('create', ['create', names[0], '--image', 'base:1.0'],
+                *(['create', name, '--template', names[0]] for name in names[1:]))
+        measure('list', ['list'])
+        measure('update-sd-units --all', ['update-sd-units', '--all'])
+        measure('fork', ['fork', names[0]])
+        measure('image gc', ['image', 'gc'])
+        measure('rm -r', ['rm', '-r', names[0]])
+    finally:
+        server.shutdown()
+
+
+@click.command()
+@click.option('--sizes', default='10,100,1000', help='Comma-separated numbers of containers to test with.')
+@click.option('--files', default=1000, help='Number of files in the image.')
+@click.option('--output', '-o', type=click.Path(dir_okay=False), help='Write the results to this JSON file.')
+@click.option('--root', type=click.Path(file_okay=False), help='Directory to run in (default: a temporary one).')
+@click.option('--keep', is_flag=True, help="Don't remove the root directory afterwards.")
+def main(sizes, files, output, root, keep):
+    """Runs kostka commands against a fake host and measures how long they take."""
+    root = Path(root or mkdtemp(prefix='kostka-bench-'))
+    try:
+        revision = subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=str(REPO),
+                                           stderr=subprocess.DEVNULL).decode('utf-8').strip()
+    except (OSError, subprocess.CalledProcessError):
+        revision = None
+    results = {
+        'revision': revision,
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'date': datetime.now(timezone.utc).isoformat(),
+        'files': files,
+        'results': [],
+    }
+
+    def report(size, operation, seconds, commands):
+        results['results'].append({
+            'containers': size,
+            'operation': operation,
+            'seconds': seconds,
+            'commands': commands,
+        })
+        print('{:>6} {:<24} {:>10.3f}s'.format(size, operation, seconds), flush=True)
+
+    try:
+        for size in (int(size) for size in sizes.split(',')):
+            benchmark(root / str(size), size, files, report)
+    finally:
+        if not keep:
+            shutil.rmtree(str(root), ignore_errors=True)
+
+    if output:
+        with open(output, 'w') as f:
+            f.write(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    main()
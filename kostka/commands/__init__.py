@@ -1,4 +1,23 @@
-from os.path import dirname, basename, isfile
-import glob
-modules = glob.glob(dirname(__file__)+"/*.py")
-__all__ = [ basename(f)[:-3] for f in modules if isfile(f)]
+# Command name -> module that defines it. Modules are only imported when
+# their command is used, see utils.LazyGroup.
+COMMANDS = {
+    'copy': 'copy',
+    'create': 'create',
+    'create-many': 'create_many',
+    'enter': 'enter',
+    'fork': 'fork',
+    'graph': 'graph',
+    'image': 'image',
+    'list': 'list',
+    'manifest': 'manifest',
+    'mount': 'mount',
+    'pid': 'pid',
+    'prepare': 'prepare',
+    'rm': 'rm',
+    'set-ip': 'set_ip',
+    'start': 'start',
+    'stop': 'stop',
+    'update-sd-units': 'update_sd_units',
+}
+
+__all__ = sorted(set(COMMANDS.values()))
@@ -11,6 +11,9 @@ from ..plugins import extensible_command
 @click.option("--template", "-t", default="debian-jessie")
 @click.pass_context
 @require_existing_container
-def copy(ctx, name, new_name, template, extensions):
+def copy(ctx, name, new_name, template, extensions, **options):
     ctx.invoke(create, name=new_name, template=template)
-    extensions(Container(name), Container(new_name))
+    new_container = Container(new_name)
+    # Options added by the extensions, e.g. --clone-mode
+    new_container.copy_options = options
+    extensions(Container(name), new_container)
@@ -1,8 +1,7 @@
 import click
 import os
 import sys
-import subprocess
-from ..utils import cli, run_hooks, Container
+from ..utils import cli, run_hooks, is_active, Container
 from .update_sd_units import update_sd_units
 from .rm import rm
 from ..plugins import extensible_command
@@ -23,24 +22,15 @@ def create(ctx, name, extensions, reload_systemd, **kwargs):
         print("Container {} already exists.".format(name), file=sys.stderr)
         sys.exit(1)
 
-    service_status = subprocess.call(["/bin/systemctl", "status", name],
-                                     stdout=subprocess.DEVNULL,
-                                     stderr=subprocess.DEVNULL)
-    if service_status == 0:
+    if is_active(name):
         print("There is already a systemd unit called {}. "
               "You can't create a container with the same name.".format(name),
               file=sys.stderr)
         sys.exit(1)
-    elif service_status not in (3, 4):
-        print("Something weird is going on with systemd "
-              "(`systemctl status {}` returned {} instead of 3 or 4). "
-              "I don't know what to do.".format(name, service_status),
-              file=sys.stderr)
-        sys.exit(1)
 
     run_hooks('pre-create', name)
 
-    os.mkdir("/var/lib/machines/{}".format(container.name))
+    os.mkdir(str(container.path))
     extensions(ctx, container, **kwargs)
 
     try:
@@ -49,7 +39,7 @@ def create(ctx, name, extensions, reload_systemd, **kwargs):
         print("Container {} has been successfully created.".format(name))
     except ValueError as e:
         print(e.args[1])
-        ctx.invoke(rm, name=name)
+        ctx.invoke(rm, name=name, reload_systemd=reload_systemd)
     except:
-        ctx.invoke(rm, name=name)
+        ctx.invoke(rm, name=name, reload_systemd=reload_systemd)
         raise
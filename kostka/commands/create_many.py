@@ -0,0 +1,138 @@
+import os
+import sys
+import click
+import yaml
+from concurrent.futures import ThreadPoolExecutor
+from ..config import config
+from ..utils import cli, systemd_reload, Container, InvocationPath
+from ..oci import Image
+from .. import systemd
+from .create import create
+from .set_ip import set_ip
+
+# Keys of a container in the spec that are not `kostka create` options
+IP_OPTIONS = ('ip', 'interface', 'gateway')
+
+
+def load_spec(path):
+    with open(path) as f:
+        spec = yaml.safe_load(f) or {}
+    defaults = spec.get('defaults') or {}
+    containers = {}
+    for name, options in (spec.get('containers') or {}).items():
+        containers[name] = dict(defaults, **(options or {}))
+    return containers
+
+
+def pull(image):
+    '''Resolves an image reference to a version and downloads it.
+       Returns the pinned reference.'''
+    if ':' not in image:
+        image += ':latest'
+    name, version = image.split(':', 1)
+    local = Image(name, version)
+    if not local.path.exists() or local.version != version:
+        # Not downloaded yet, or a tag like "latest" that has to be resolved
+        index = Image.download_index(name, version)
+        version = index['annotations']['kostka.image.version']
+    Image.download(name, version, extract=True)
+    return '{}:{}'.format(name, version)
+
+
+@cli.command(name='create-many')
+@click.argument('spec', type=InvocationPath(exists=True, dir_okay=False))
+@click.option('--workers', '-j', type=int, default=0, help='How many containers to create at once (default: CPU count).')
+@click.pass_context
+def create_many(ctx, spec, workers):
+    """Create all containers described in a YAML file.
+
+    \b
+    containers:
+      web1:
+        image: debian:1.2,web:3.4
+        bridge: [br-lan]
+        ip: 10.0.0.5/24
+        gateway: 10.0.0.1
+
+    Every container takes the options of `kostka create` and optionally
+    ip, interface and gateway for `kostka set-ip`. Options under `defaults`
+    apply to all containers. Every image is downloaded once, and systemd is
+    reloaded once at the end."""
+
+    containers = load_spec(spec)
+    params = {param.name: param for param in create.params}
+    errors = {}
+
+    # Check all options before creating anything
+    for name, options in containers.items():
+        for key, value in list(options.items()):
+            if key in IP_OPTIONS:
+                continue
+            param = params.get(key.replace('-', '_'))
+            if param is None or key == 'name':
+                errors[name] = 'Unknown option: {}'.format(key)
+                break
+            if param.multiple and isinstance(value, str):
+                value = [value]
+            try:
+                options[key] = param.type_cast_value(ctx, value)
+            except (click.BadParameter, ValueError) as e:
+                errors[name] = 'Invalid {}: {}'.format(key, e)
+                break
+
+    # Download every image once, before the containers that use it are created
+    images = {}
+    for name, options in containers.items():
+        if name not in errors and options.get('image'):
+            for image in options['image'].split(','):
+                images[image] = None
+
+    def resolve(image):
+        try:
+            return pull(image), None
+        except Exception as e:
+            return None, e
+
+    with ThreadPoolExecutor(max_workers=config['download_workers']) as executor:
+        images = dict(zip(images, executor.map(resolve, images)))
+
+    for name, options in containers.items():
+        if name in errors or not options.get('image'):
+            continue
+        pinned = []
+        for image in options['image'].split(','):
+            resolved, error = images[image]
+            if error is not None:
+                errors[name] = 'Cannot download {}: {}'.format(image, error)
+                break
+            pinned.append(resolved)
+        options['image'] = ','.join(pinned)
+
+    def create_container(name):
+        options = containers[name]
+        kwargs = {key.replace('-', '_'): value for key, value in options.items() if key not in IP_OPTIONS}
+        try:
+            ctx.invoke(create, name=name, reload_systemd=False, **kwargs)
+            if not Container(name).exists():
+                return 'Container was removed after a failure'
+            if 'ip' in options:
+                ctx.invoke(set_ip, name=name, cidr=options['ip'],
+                           interface=options.get('interface', 'host0'), gateway=options.get('gateway'))
+        except (Exception, SystemExit) as e:
+            return str(e) or e.__class__.__name__
+
+    pending = [name for name in containers if name not in errors]
+    with ThreadPoolExecutor(max_workers=workers or os.cpu_count()) as executor:
+        for name, error in zip(pending, executor.map(create_container, pending)):
+            if error is not None:
+                errors[name] = error
+
+    # Failed containers were removed without reloading systemd as well
+    if systemd.units.changed > 0 or len(errors) > 0:
+        systemd_reload()
+
+    for name, error in sorted(errors.items()):
+        print("Creating {} failed: {}".format(name, error), file=sys.stderr)
+    print("Created {} containers, {} failed.".format(len(containers) - len(errors), len(errors)))
+    if len(errors) > 0:
+        ctx.exit(1)
@@ -1,16 +1,18 @@
-import subprocess
 import click
 import os
 from ..utils import cli
 from ..container import Container
+from .. import graph, clone
 from .update_sd_units import all_units
 
 
 @cli.command()
 @click.argument('name')
 @click.option('--update', is_flag=True, help='Update dependencies of this container to their newest versions.')
+@click.option('--clone-mode', type=click.Choice(clone.MODES),
+              help='How to copy the overlay: reflink, copy, or auto (reflink if the filesystem supports it).')
 @click.pass_context
-def fork(ctx, name, update):
+def fork(ctx, name, update, clone_mode):
     """Create a new copy of the container's overlay and switch existing children to use it.
 
     The basic idea is to be able to update the container without affecting others that
@@ -31,15 +33,19 @@ def fork(ctx, name, update):
     if update:
         os.mkdir(dst)
     else:
-        subprocess.check_call(['cp', '-a', src, dst])
+        mode, copied = clone.clone(src, dst, clone_mode)
+        print('Copied the overlay using {}: {} bytes copied.'.format(mode, copied))
 
     (container.path / 'overlay.fs').unlink()
     (container.path / 'overlay.fs').symlink_to(dst)
 
-    for cont in Container.all():
+    for child in graph.children(container.name):
+        cont = Container(child)
+        if not cont.exists():
+            continue
         modified = False
         for dependency in cont.dependencies:
-            if dependency['imageName'] != container.name:
+            if dependency.get('imageName') != container.name:
                 continue
 
             if 'path' in dependency:
@@ -0,0 +1,42 @@
+import click
+import json
+from ..utils import cli
+from .. import graph as dependency_graph
+
+
+@cli.command('graph')
+@click.argument('name', required=False)
+@click.option('--ancestors', '-a', is_flag=True, help='Show everything the container uses, directly or not.')
+@click.option('--descendants', '-d', is_flag=True, help='Show all containers that use the container or image.')
+@click.option('--json', 'json_output', is_flag=True, help='Print the graph as a JSON document.')
+@click.option('--rebuild', is_flag=True, help='Rebuild the graph from container manifests.')
+def graph_command(name, ancestors, descendants, json_output, rebuild):
+    """Show the dependencies between containers and images.
+
+    Without NAME, prints the dependencies of every container. With NAME
+    (a container or image:NAME:VERSION), prints its dependencies and children."""
+
+    graph = dependency_graph.rebuild() if rebuild else dependency_graph.load()
+
+    if name is None:
+        if json_output:
+            print(json.dumps(graph, indent=2, sort_keys=True))
+            return
+        for container, nodes in sorted(graph['dependencies'].items()):
+            print('{}: {}'.format(container, ', '.join(nodes)))
+        return
+
+    if ancestors:
+        deps = dependency_graph.ancestors(name, graph)
+    else:
+        deps = dependency_graph.dependencies(name, graph)
+    if descendants:
+        children = dependency_graph.descendants(name, graph)
+    else:
+        children = dependency_graph.children(name, graph)
+
+    if json_output:
+        print(json.dumps({'dependencies': deps, 'children': children}, indent=2))
+    else:
+        print('Dependencies: {}'.format(', '.join(deps) or '-'))
+        print('Children: {}'.format(', '.join(children) or '-'))
@@ -1,10 +1,18 @@
+import sys
+import shutil
 import subprocess
+from pathlib import Path
 from distutils.version import StrictVersion
 import click
-import requests
+from .. import hub
 from ..config import config
 from ..utils import cli, Container
-from ..oci import Image, Blob
+from ..oci import Image, Blob, Layer, DownloadError, tree_size
+from ..lock import store_lock
+from .. import compression as compressions
+from .. import metadata
+from .. import squash
+from ..mount import load_lowerdir_cache
 
 
 @cli.group()
@@ -20,9 +28,14 @@ def ls():
 
 @image.command()
 @click.option('--force', is_flag=True, help='Delete and recreate the image if it already exists.')
+@click.option('--compression', type=click.Choice(sorted(compressions.compressions)),
+              help='Layer compression (default: {}).'.format(config['layer_compression']))
+@click.option('--compression-level', type=int, help='Compression level passed to the compressor.')
+@click.option('--max-layers', type=click.IntRange(min=1),
+              help='Squash the bottom layers into one if the image would have more layers.')
 @click.argument('container')
 @click.argument('name')
-def create(container, name, force):
+def create(container, name, force, compression=None, compression_level=None, max_layers=None):
     if isinstance(container, str):
         container = Container(container)
 
@@ -32,13 +45,21 @@ def create(container, name, force):
         except FileNotFoundError:
             pass
     try:
-        with Image.create(name) as image:
+        with Image.create(name, compression=compression, compression_level=compression_level) as image:
             print("Created image {}. Adding layers.".format(name))
-            for layer in reversed(list(container.mount_lowerdirs())):
-                print("Adding layer {}.".format(layer))
-                image.add_layer(layer)
-            print("Adding layer {}.".format(container.path / 'overlay.fs'))
-            image.add_layer(container.path / 'overlay.fs')
+            layers = [(container.path / 'overlay.fs', None)] + container.mount_layers()
+            layers, squashed = squash.split(layers, max_layers)
+            if len(squashed) > 0:
+                print("Squashing {} layers.".format(len(squashed)))
+                image.add_layer(*(path for path, layer in reversed(squashed)))
+            for path, layer in reversed(layers):
+                if layer is not None:
+                    # This lowerdir is an extracted image layer, no need to build it again
+                    print("Reusing layer {}:{}.".format(layer.digest_alg, layer.digest))
+                    image.add_existing_layer(layer)
+                else:
+                    print("Adding layer {}.".format(path))
+                    image.add_layer(path)
             print("Writing metadata.")
     except FileExistsError:
         raise
@@ -48,27 +69,119 @@ def create(container, name, force):
 
 
 @image.command()
-def gc():
-    used_hashes = {}
-    for img in Image:
-        for alg in (img.path / 'blobs').iterdir():
-            if alg.name not in used_hashes:
-                used_hashes[alg.name] = set()
-            for digest in alg.iterdir():
-                used_hashes[alg.name].add(digest.name)
-
-    for alg in Blob.root.iterdir():
-        if alg.is_file():
+@click.option('--dry-run', is_flag=True, help='Only show what would be removed.')
+def gc(dry_run):
+    """Remove blobs and extracted layers that are not used by any image or container."""
+    freed = 0
+
+    def remove(path, description, size=None):
+        nonlocal freed
+        if size is None:
+            size = tree_size(path)
+        freed += size
+        if dry_run:
+            print('Would remove {} ({} bytes)'.format(description, size))
+            return
+        print('Removing {} ({} bytes)'.format(description, size))
+        if path.is_dir() and not path.is_symlink():
+            shutil.rmtree(str(path))
+        else:
+            path.unlink()
+
+    with store_lock(exclusive=True):
+        # Mark: blobs are used by images, extracted layers by containers
+        used_blobs = metadata.used_blobs()
+        # Images the index doesn't know about (copied in by hand, or written
+        # by a kostka that crashed before indexing them) keep their blobs too
+        for directory in Image._subdirs(Image.root):
+            for version in Image._subdirs(directory):
+                for alg in Image._subdirs(version / 'blobs'):
+                    used_blobs.update('{}:{}'.format(alg.name, link.name) for link in alg.iterdir())
+        used_layers = set()
+        used_squashes = squash.referenced()
+        sweep_layers = True
+        lowerdir_cache = load_lowerdir_cache()
+        for container in Container.all():
+            try:
+                # Only what's in the store, gc must not download anything while holding the lock
+                layers = container.mount_layers(fetch=False)
+            except (OSError, ValueError, KeyError, IndexError) as e:
+                # The lowerdirs the container was last mounted with are still known
+                cached = lowerdir_cache.get(container.name)
+                if cached is None:
+                    print("Cannot resolve layers of {}: {}. Not removing any extracted layers.".format(
+                        container.name, e), file=sys.stderr)
+                    sweep_layers = False
+                    continue
+                layers = [(path, Layer(Path(path).parent.name, Path(path).name)
+                           if Path(path).parent.parent == Layer.root else None)
+                          for path in cached['lowerdirs']]
+            for path, layer in layers:
+                if layer is not None:
+                    used_layers.add(layer.name)
+                    used_blobs.add(layer.name)
+            lowerdirs, squashed = squash.split([path for path, layer in layers], container.max_lowerdirs())
+            if len(squashed) > 0:
+                used_squashes.add(squash.path(squashed).name)
+
+        # Sweep, with the sizes from the index where it has them
+        blob_sizes = metadata.blobs()
+        layer_sizes = metadata.extracted_layers()
+        for alg in sorted(Blob.root.iterdir()):
             if alg.name.startswith('tmp'):
-                print('Removing temporary garbage: {}'.format(alg))
-                alg.unlink()
-            else:
+                remove(alg, 'temporary garbage: {}'.format(alg))
+                continue
+            if alg.is_file():
                 print("Unknown file: {}. It probably shouldn't be here.".format(alg))
-            continue
-        for digest in alg.iterdir():
-            if alg.name not in used_hashes or digest.name not in used_hashes[alg.name]:
-                print("Removing {}:{}".format(alg.name, digest.name))
-                digest.unlink()
+                continue
+            for digest in sorted(alg.iterdir()):
+                name = '{}:{}'.format(alg.name, digest.name)
+                if name not in used_blobs:
+                    remove(digest, 'blob {}'.format(name), blob_sizes.get(name))
+                    if not dry_run:
+                        metadata.remove_blob(name)
+
+        if sweep_layers and Layer.root.exists():
+            for alg in sorted(Layer.root.iterdir()):
+                for digest in sorted(alg.iterdir()):
+                    name = '{}:{}'.format(alg.name, digest.name)
+                    if digest.name.startswith('tmp'):
+                        remove(digest, 'interrupted extraction: {}'.format(digest))
+                    elif name not in used_layers:
+                        remove(digest, 'extracted layer {}'.format(name), layer_sizes.get(name))
+                        if not dry_run:
+                            metadata.remove_layer(name)
+
+        if sweep_layers and squash.root.exists():
+            for path in sorted(squash.root.iterdir()):
+                if path.name not in used_squashes:
+                    remove(path, 'squashed lowerdirs {}'.format(path.name))
+
+    print('{} {} bytes.'.format('Would free' if dry_run else 'Freed', freed))
+
+
+@image.command()
+@click.option('--repair', is_flag=True, help='Download corrupt blobs and extract incomplete layers again.')
+@click.option('--force', is_flag=True,
+              help='Also repair layers that running containers use. They have to be restarted afterwards.')
+@click.option('--all', 'check_all', is_flag=True, help='Also check blobs and layers that were verified before.')
+@click.option('--workers', '-j', type=int, default=0, help='Number of processes to use (default: CPU count).')
+def fsck(repair, force, check_all, workers):
+    """Check that blobs match their digests and extracted layers are complete.
+
+    Only blobs and layers that were added or changed since the last check
+    are read, unless --all is given."""
+    from ..fsck import check
+    problems = check(repair=repair, check_all=check_all, force=force, workers=workers)
+    if problems > 0:
+        print('{} problems {}.'.format(problems, 'left' if repair else 'found'), file=sys.stderr)
+        sys.exit(1)
+
+
+@image.command()
+def reindex():
+    """Rebuild the image metadata index from the files on disk."""
+    Image.reindex()
 
 
 @image.command()
@@ -78,7 +191,7 @@ def download(name):
         print('Image hub not configured. Cannot download image.')
     name = name.split(':', 1)
     if len(name) == 1:
-        versions = requests.get('{}/images/{}'.format(config['image_hub'], name[0])).json()
+        versions = hub.get_json('{}/images/{}'.format(config['image_hub'], name[0]))
         versions = sorted((d['name'] for d in versions), key=StrictVersion)
         name.append(versions[-1])
     name, version = name
@@ -87,11 +200,35 @@ def download(name):
     Image.download(name, version)
 
 
+@image.command()
+@click.option('--bind', '-b', default='',
+              help='Address to listen on (default: all addresses, so anyone who can connect can download the images).')
+@click.option('--port', '-p', type=int, default=8080, help='Port to listen on.')
+@click.option('--verbose', '-v', is_flag=True, help='Log every request.')
+@click.option('--accept-uploads', is_flag=True,
+              help='Accept images uploaded with HTTP PUT. Anyone who can connect can upload.')
+def serve(bind, port, verbose, accept_uploads):
+    """Serve the local images to other hosts.
+
+    Uses the layout of the image hub, so other hosts can set image_hub to
+    http://<this host>:<port> and download images from here."""
+    from ..serve import serve
+    serve(bind, port, verbose, accept_uploads)
+
+
 @image.command()
 @click.argument('name')
 def upload(name):
-    if not config['image_upload_host']:
-        print('Image upload not configured. Cannot download image.')
+    """Upload an image to image_upload_url or image_upload_host.
+
+    Only the blobs the destination doesn't have yet are uploaded, and the
+    image becomes visible there once all of them have arrived."""
+    from ..upload import destination, upload, UploadError
+    try:
+        dest = destination()
+    except UploadError as e:
+        print(e, file=sys.stderr)
+        sys.exit(1)
     name = name.split(':', 1)
     if len(name) == 1:
         versions = (path.name for path in (Image.root / name[0]).iterdir())
@@ -102,21 +239,8 @@ def upload(name):
 
     image = Image(name, version)
     image.load()
-
-    rsync_command = ['rsync']
-    if config['image_upload_ssh_command']:
-        rsync_command += ['--rsh={}'.format(config['image_upload_ssh_command'])]
-
-    subprocess.check_call(rsync_command + [
-        '-aPR', '--chmod=755', '{}/{}/index.json'.format(name, version),
-        '{}:images/'.format(config['image_upload_host'])], cwd=str(Image.root)
-    )
-
-    blobs = image.layers[:]
-    blobs.append(Blob.from_str(image.manifest))
-    blobs.append(Blob.from_str(image.config))
-    files = ['{}/{}'.format(blob.digest_alg, blob.digest) for blob in blobs]
-    subprocess.check_call(
-        rsync_command + ['-aPR', '--chmod=755'] + files +
-        ['{}:blobs/'.format(config['image_upload_host'])], cwd=str(Blob.root)
-    )
+    try:
+        upload(image, dest)
+    except (UploadError, DownloadError, KeyError, OSError, subprocess.CalledProcessError) as e:
+        print(e, file=sys.stderr)
+        sys.exit(1)
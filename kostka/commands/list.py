@@ -1,34 +1,85 @@
-import os
 import json
+import time
 import click
-import subprocess
-from ..utils import cli, container_exists
+from ..utils import cli, service_properties, Container
+
+COLUMNS = {
+    'sub': 'SubState',
+    'pid': 'MainPID',
+    'memory': 'MemoryCurrent',
+    'uptime': 'ActiveEnterTimestampMonotonic',
+}
+
+
+def column_value(column, properties):
+    value = properties.get(COLUMNS[column], '')
+    if column == 'sub':
+        return value
+    if not value.isdigit():
+        return None  # "[not set]" and similar
+    value = int(value)
+    if column == 'memory':
+        return None if value >= 2 ** 64 - 1 else value
+    if column == 'uptime':
+        if value == 0 or properties.get('ActiveState') != 'active':
+            return None
+        return int(time.clock_gettime(time.CLOCK_MONOTONIC) - value / 1000000)
+    return value or None
+
+
+def format_value(column, value):
+    if value is None:
+        return '-'
+    if column == 'memory':
+        for unit in ('B', 'K', 'M', 'G'):
+            if value < 1024:
+                break
+            value /= 1024
+        else:
+            unit = 'T'
+        return '{:.1f}{}'.format(value, unit) if unit != 'B' else '{}B'.format(value)
+    if column == 'uptime':
+        days, value = divmod(value, 86400)
+        uptime = '{:02}:{:02}:{:02}'.format(value // 3600, value // 60 % 60, value % 60)
+        return '{}d {}'.format(days, uptime) if days else uptime
+    return str(value)
 
 
 @cli.command('list')
 @click.option('--json', 'json_output', is_flag=True, help='Print the list as a JSON document.')
 @click.option('--status', help='Show only hosts with a given status.')
-def list_containers(json_output, status):
-    machines = sorted(os.listdir('/var/lib/machines'))
-    machines = list(filter(container_exists, machines))
+@click.option('--columns', '-c', default='',
+              help='Comma-separated list of extra columns to show: {}.'.format(', '.join(sorted(COLUMNS))))
+def list_containers(json_output, status, columns):
+    columns = [column for column in columns.split(',') if column]
+    for column in columns:
+        if column not in COLUMNS:
+            raise click.BadParameter('Unknown column: {}'.format(column), param_hint='--columns')
+
+    machines = [container.name for container in Container.all()]
     if len(machines) > 0:
         max_name_length = max(map(len, machines))
+
+    # A single `systemctl show` call for all containers
+    properties = ['ActiveState'] + [COLUMNS[column] for column in columns]
+    states = service_properties(machines, properties)
+
     result = {}
     for machine in machines:
-        try:
-            service_status = subprocess.check_output(['systemctl', 'show', machine]).decode('utf-8').strip()
-        except subprocess.CalledProcessError as e:
-            service_status = e.output.decode('utf-8').strip()
-
-        service_status = dict(line.split("=", 1) for line in service_status.split("\n"))
-        active = service_status['ActiveState']
+        state = states.get(machine, {})
+        active = state.get('ActiveState', 'unknown')
         if status is not None and active != status:
             continue
 
+        values = [column_value(column, state) for column in columns]
         if json_output:
-            result[machine] = active
+            if columns:
+                result[machine] = dict(zip(['state'] + columns, [active] + values))
+            else:
+                result[machine] = active
         else:
             machine = "{{:<{}}}".format(max_name_length).format(machine)
-            print("{} {}".format(machine, active))
+            values = [format_value(column, value) for column, value in zip(columns, values)]
+            print(' '.join([machine, '{:<12}'.format(active) if columns else active] + values))
     if json_output:
         print(json.dumps(result))
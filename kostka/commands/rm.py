@@ -2,8 +2,9 @@ import click
 import sys
 import os
 import shutil
-import subprocess
 from ..utils import cli, require_existing_container, systemd_reload, run_hooks, Container
+from ..config import config
+from .. import systemd, graph
 from ..plugins import extensible_command
 
 
@@ -17,30 +18,32 @@ from ..plugins import extensible_command
 def rm(ctx, name, recursive, extensions, reload_systemd):
     """ Removes a container """
 
-    children = list(filter(lambda c: name in c.dependencies, Container.all()))
+    children = [child for child in graph.children(name) if Container(child).exists()]
     if len(children) > 0:
         if recursive:
-            for container in children:
-                ctx.invoke(rm, name=container.name, recursive=recursive)
+            for child in children:
+                ctx.invoke(rm, name=child, recursive=recursive)
         else:
-            children = ', '.join(map(lambda c: c.name, children))
+            children = ', '.join(children)
             print("Container {} is in use by {}. Not removing.".format(name, children))
             sys.exit(1)
 
-    if os.path.exists('/etc/systemd/systemd/{}.service'.format(name)):
-        subprocess.check_call(['/bin/systemctl', 'kill', name])
-        subprocess.check_call(['/bin/systemctl', 'kill', name])
+    service = os.path.join(config['unit_dir'], '{}.service'.format(name))
+    if os.path.exists(service) and systemd.backend().is_active(name):
+        systemd.backend().kill(name)
+        systemd.backend().kill(name)
     extensions(Container(name))
 
     try:
-        os.remove('/etc/systemd/system/{}.service'.format(name))
+        os.remove(service)
     except FileNotFoundError:
         pass
 
     try:
-        shutil.rmtree('/var/lib/machines/{}'.format(name))
+        shutil.rmtree(str(Container(name).path))
     except FileNotFoundError:
         pass
+    graph.remove(name)
 
     if reload_systemd:
         systemd_reload()
@@ -1,7 +1,8 @@
 import click
 import os
 import re
-from ..utils import cli, require_existing_container, is_active
+from ..utils import cli, require_existing_container, is_active, Container
+from ..systemd import escape_path
 from .enter import enter
 from .mount import mount
 from pathlib import Path
@@ -21,8 +22,8 @@ def set_ip(ctx, name, cidr, interface, gateway):
         `kostka set-ip CONTAINER dhcp` to get the address from
         a DHCP server.
     """
-    path = '/var/lib/machines/' + name
-    if is_active('var-lib-machines-{}-fs.mount'.format(name)):
+    path = str(Container(name).path)
+    if is_active(escape_path(Path(path) / 'fs') + '.mount'):
         # Now if the overlayfs is mounted, we should use it:
         path += '/fs'
     elif not (Path(path) / 'init.fs').exists():
@@ -32,34 +33,30 @@ def set_ip(ctx, name, cidr, interface, gateway):
         # Otherwise, use the overlay directly
         path += '/init.fs'
 
-    cwd = os.getcwd()
-    os.chdir(path)
+    directory = os.path.join(path, 'etc/network/interfaces.d')
     try:
-        try:
-            os.makedirs('etc/network/interfaces.d')
-        except FileExistsError:
-            pass
+        os.makedirs(directory)
+    except FileExistsError:
+        pass
 
-        with open('etc/network/interfaces.d/' + interface, 'w') as f:
-            if cidr == 'dhcp':
-                template = """
-                auto {interface}
-                iface {interface} inet dhcp
-                """.format(interface=interface)
-            else:
-                ip, netmask = cidr.split('/', 1)
-                template = """
-                auto {interface}
-                iface {interface} inet static
-                    address {ip}
-                    netmask {netmask}
-                """.format(ip=ip, netmask=netmask, interface=interface)
-                if gateway is not None:
-                    template += "    gateway {gateway}\n".format(gateway=gateway)
-            template = re.sub(r"^ {16}", "", template, flags=re.MULTILINE).lstrip()
-            f.write(template)
-    finally:
-        os.chdir(cwd)
+    with open(os.path.join(directory, interface), 'w') as f:
+        if cidr == 'dhcp':
+            template = """
+            auto {interface}
+            iface {interface} inet dhcp
+            """.format(interface=interface)
+        else:
+            ip, netmask = cidr.split('/', 1)
+            template = """
+            auto {interface}
+            iface {interface} inet static
+                address {ip}
+                netmask {netmask}
+            """.format(ip=ip, netmask=netmask, interface=interface)
+            if gateway is not None:
+                template += "    gateway {gateway}\n".format(gateway=gateway)
+        template = re.sub(r"^ {12}", "", template, flags=re.MULTILINE).lstrip()
+        f.write(template)
 
     # We want it to work both for running and not running containers.
     # If the container is running, we have to set it's ip without rebooting it.
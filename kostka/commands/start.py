@@ -1,6 +1,6 @@
 import click
-import subprocess
 from ..utils import cli, require_existing_container, run_hooks
+from .. import systemd
 
 
 @cli.command()
@@ -8,5 +8,5 @@ from ..utils import cli, require_existing_container, run_hooks
 @require_existing_container
 def start(name):
     run_hooks('pre-start', name)
-    subprocess.check_call(['/bin/systemctl', 'start', name])
+    systemd.backend().start(name)
     run_hooks('post-start', name)
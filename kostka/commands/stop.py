@@ -1,6 +1,6 @@
 import click
-import subprocess
 from ..utils import cli, require_existing_container, run_hooks, Container
+from .. import systemd
 from ..plugins import extensible_command
 
 
@@ -10,6 +10,6 @@ from ..plugins import extensible_command
 @require_existing_container
 def stop(name, extensions):
     run_hooks('pre-stop', name)
-    subprocess.check_call(['/bin/systemctl', 'stop', name])
+    systemd.backend().stop(name)
     extensions(Container(name))
     run_hooks('post-stop', name)
@@ -1,15 +1,35 @@
+import os
+import sys
 import click
+from concurrent.futures import ThreadPoolExecutor
+from ..config import config
 from ..utils import cli, systemd_reload, require_existing_container, Container
 from ..plugins import extensible_command
+from .. import systemd
 
 
 def all_units(ctx, param, value):
     if not value:
         return
-    for machine in Container.all():
-        ctx.invoke(update_sd_units, name=machine.name, reload_sd=False)
-    systemd_reload()
-    ctx.exit()
+
+    def update(machine):
+        try:
+            # The container from the inventory, so that its manifest isn't read again
+            ctx.invoke(update_sd_units, name=machine.name, reload_sd=False, container=machine)
+            return True
+        except (Exception, SystemExit) as e:
+            print("Updating units of {} failed: {}".format(machine.name, e), file=sys.stderr)
+            return False
+
+    machines = Container.all()
+    with ThreadPoolExecutor(max_workers=config['update_workers'] or os.cpu_count()) as executor:
+        results = list(executor.map(update, machines))
+
+    # Reloading systemd is expensive, so only do it when something has actually changed
+    if systemd.units.changed > 0:
+        systemd_reload()
+    print("{} units changed, {} unchanged.".format(systemd.units.changed, systemd.units.unchanged))
+    ctx.exit(0 if all(results) else 1)
 
 
 @cli.command(name='update-sd-units')
@@ -17,10 +37,12 @@ def all_units(ctx, param, value):
 @click.argument('name')
 @click.option("--all", "-a", is_flag=True, help="Update systemd units of all containers.", callback=all_units, is_eager=True, expose_value=False)
 @require_existing_container
-def update_sd_units(name, extensions, reload_sd=True):
+def update_sd_units(name, extensions, reload_sd=True, container=None):
     """ Recreate the systemd units for the container. """
 
-    container = Container(name)
+    if container is None:
+        container = Container(name)
+    changed_units = systemd.units.changed
 
     nspawn_args = [
         '--quiet',
@@ -39,7 +61,7 @@ def update_sd_units(name, extensions, reload_sd=True):
 
     container_service['Service'] = {
         'ExecStart': 'systemd-nspawn {nspawn_args}',
-        'ExecStop': '/bin/machinectl poweroff {}'.format(name),
+        'ExecStop': '{} poweroff {}'.format(config['machinectl'], name),
         'KillMode': 'mixed',
         'Type': 'notify',
         'RestartForceExitStatus': '133',
@@ -50,22 +72,26 @@ def update_sd_units(name, extensions, reload_sd=True):
         'WantedBy': 'default.target'
     }
 
-    extensions(container, container_service, nspawn_args, capabilities)
+    # Extensions that write units themselves, instead of with systemd.write_unit,
+    # return True when they changed one, so that systemd is reloaded
+    if any(extensions(container, container_service, nspawn_args, capabilities)):
+        systemd.units.mark_changed()
     if len(capabilities) > 0:
         nspawn_args.append('--capability {}'.format(','.join(capabilities)))
 
     container_service['Service']['ExecStart'] = container_service['Service']['ExecStart'].format(nspawn_args=' '.join(nspawn_args))
 
     # Prepare the container service
-    with open("/etc/systemd/system/{}.service".format(name), 'w') as f:
-        for (section_name, section) in container_service.items():
-            f.write('\n[{}]\n'.format(section_name))
-            for (name, value) in section.items():
-                if isinstance(value, list):
-                    for v in value:
-                        f.write("{}={}\n".format(name, v))
-                else:
-                    f.write("{}={}\n".format(name, value))
+    unit = ''
+    for (section_name, section) in container_service.items():
+        unit += '\n[{}]\n'.format(section_name)
+        for (key, value) in section.items():
+            if isinstance(value, list):
+                for v in value:
+                    unit += "{}={}\n".format(key, v)
+            else:
+                unit += "{}={}\n".format(key, value)
+    systemd.write_unit(os.path.join(config['unit_dir'], '{}.service'.format(name)), unit)
 
-    if reload_sd:
+    if reload_sd and systemd.units.changed > changed_units:
         systemd_reload()
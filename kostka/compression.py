@@ -0,0 +1,73 @@
+import os
+import shutil
+from .config import config
+
+TAR_MEDIA_TYPE = 'application/vnd.oci.image.layer.v1.tar'
+GZIP_MEDIA_TYPE = 'application/vnd.oci.image.layer.v1.tar+gzip'
+ZSTD_MEDIA_TYPE = 'application/vnd.oci.image.layer.v1.tar+zstd'
+DOCKER_TAR_MEDIA_TYPE = 'application/vnd.docker.image.rootfs.diff.tar'
+DOCKER_GZIP_MEDIA_TYPE = 'application/vnd.docker.image.rootfs.diff.tar.gzip'
+
+
+def threads():
+    return config['compression_threads'] or os.cpu_count() or 1
+
+
+class Compression:
+    '''A compression program used for layers.
+
+       All of them have to produce deterministic output, so that building the
+       same layer twice gives the same digest.'''
+    def __init__(self, name, media_type, program, default_level, options):
+        self.name = name
+        self.media_type = media_type
+        self.program = program
+        self.default_level = default_level
+        self.options = options
+
+    def level(self, level=None):
+        if level is not None:
+            return level
+        if config['layer_compression_level'] is not None:
+            return config['layer_compression_level']
+        return self.default_level
+
+    def compress_command(self, level=None):
+        return [self.program] + self.options() + ['-{}'.format(self.level(level))]
+
+    def decompress_program(self):
+        '''Command line for `tar --use-compress-program`, which adds `-d` itself'''
+        return ' '.join([self.program] + self.options())
+
+
+compressions = {
+    # gzip -n doesn't store the file name and timestamp, which would make the output non-deterministic
+    'gzip': Compression('gzip', GZIP_MEDIA_TYPE, 'gzip', 6, lambda: ['-n']),
+    # pigz output does not depend on the number of threads
+    'pigz': Compression('pigz', GZIP_MEDIA_TYPE, 'pigz', 6, lambda: ['-n', '-p', str(threads())]),
+    # Neither does zstd's, as long as it's running in multi-threaded mode at all
+    'zstd': Compression('zstd', ZSTD_MEDIA_TYPE, 'zstd', 3, lambda: ['-q', '-c', '-T{}'.format(threads())]),
+}
+
+# Only used to extract uncompressed layers: gzip -f passes through data that isn't gzip
+uncompressed = Compression('none', TAR_MEDIA_TYPE, 'gzip', None, lambda: ['-f'])
+
+
+def get(name=None):
+    name = name or config['layer_compression']
+    if name not in compressions:
+        raise ValueError('Unknown layer compression: {}'.format(name))
+    return compressions[name]
+
+
+def for_media_type(media_type):
+    '''Returns the fastest available decompressor for a layer media type'''
+    if media_type == ZSTD_MEDIA_TYPE:
+        return compressions['zstd']
+    if media_type in (TAR_MEDIA_TYPE, DOCKER_TAR_MEDIA_TYPE):
+        return uncompressed
+    if media_type in (GZIP_MEDIA_TYPE, DOCKER_GZIP_MEDIA_TYPE):
+        if shutil.which('pigz'):
+            return compressions['pigz']
+        return compressions['gzip']
+    raise ValueError('Unsupported layer media type: {}'.format(media_type))
@@ -1,17 +1,61 @@
-import yaml
+import os
+
 
 config = {
+    'machines_dir': '/var/lib/machines',
+    'unit_dir': '/etc/systemd/system',
+    'systemctl': '/bin/systemctl',
+    'machinectl': '/bin/machinectl',
+    # None means kostka's own hooks, /usr/lib/kostka/hooks, /etc/kostka/hooks and hooks of plugins
+    'hook_dirs': None,
     'image_hub': None,
     'image_upload_host': None,
     'image_upload_ssh_command': None,
+    # Uploads with HTTP PUT instead of rsync when set, e.g. to `kostka image serve --accept-uploads`
+    'image_upload_url': None,
+    # Largest blob `kostka image serve --accept-uploads` accepts, in bytes
+    'max_upload_size': 64 * 1024 ** 3,
+    'upload_workers': 4,
     'image_root': '/var/lib/kostka/images',
     'blob_root': '/var/lib/kostka/blobs',
     'layer_root': '/var/lib/kostka/layers',
+    'layer_cache': '/var/lib/kostka/layer-cache.json',
+    'squash_root': '/var/lib/kostka/squashed',
+    'max_lowerdirs': 32,
+    'clone_mode': 'auto',
+    'metadata_index': '/var/lib/kostka/index.sqlite',
+    'lock_path': '/var/lib/kostka/lock',
+    'container_inventory': '/var/lib/kostka/containers.json',
+    'systemd_backend': 'auto',
+    'systemd_timeout': 90,
+    'update_workers': 0,
+    'offline': False,
+    'hook_timeout': 0,
+    'hook_timing': False,
+    'plugin_cache': '/var/lib/kostka/entry-points.json',
+    'lowerdir_cache': '/var/lib/kostka/lowerdirs.json',
+    'container_graph': '/var/lib/kostka/graph.json',
+    'download_workers': 4,
+    'download_attempts': 5,
+    'layer_compression': 'gzip',
+    'layer_compression_level': None,
+    'compression_threads': 0,
+    'stream_layers': True,
+    'keep_layer_blobs': True,
+    'hub_connect_timeout': 10,
+    'hub_read_timeout': 60,
+    'hub_retries': 3,
+    'hub_backoff_factor': 0.5,
+    # Indexes of pinned versions are cached forever, tags like "latest" and
+    # version listings are revalidated when they are older than hub_cache_ttl seconds
+    'hub_cache': '/var/lib/kostka/hub-cache.json',
+    'hub_cache_ttl': 300,
 }
 
 try:
-    with open('/etc/kostka.yml') as f:
-        yml = yaml.load(f.read())
+    with open(os.environ.get('KOSTKA_CONFIG', '/etc/kostka.yml')) as f:
+        import yaml  # Imported here, because it's slow to import
+        yml = yaml.safe_load(f.read())
     for (key, value) in yml.items():
         if key in config:
             config[key] = value
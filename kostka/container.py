@@ -3,10 +3,13 @@ import os
 import json
 from .plugins import extend_with
 from pathlib import Path
+from tempfile import NamedTemporaryFile
+from .config import config
+from . import graph
 
 
 class BaseContainer:
-    metadata_dir = Path('/var/lib/machines')
+    metadata_dir = Path(config['machines_dir'])
 
     def __init__(self, name):
         self.name = name
@@ -15,16 +18,53 @@ class BaseContainer:
     # For now, we assume that all containers have a directory in the metadata directory
     @classmethod
     def all(cls):
-        def exists(container):
-            return container.name == os.path.basename(container.name) \
-               and container.exists()
+        # Parsed manifests are cached between runs, and only the ones
+        # that changed since the last run are parsed again.
+        inventory = cls.load_inventory()
+        updated = {}
+        machines = []
+        for name in sorted(os.listdir(str(cls.metadata_dir))):
+            container = cls(name)
+            try:
+                st = container.manifest_path().stat()
+            except (FileNotFoundError, NotADirectoryError):
+                continue
+            machines.append(container)
 
-        machines = sorted(cls.metadata_dir.iterdir())
-        machines = list(cls(str(name.name)) for name in machines)
-        machines = list(filter(exists, machines))
+            key = [st.st_ino, st.st_size, st.st_mtime_ns, st.st_ctime_ns]
+            entry = inventory.get(name)
+            if entry is None or entry['stat'] != key:
+                try:
+                    with container.manifest_path().open() as f:
+                        entry = {'stat': key, 'manifest': json.loads(f.read())}
+                except (OSError, ValueError):
+                    continue  # Let it fail when the manifest is actually used
+            updated[name] = entry
+            container._cached_values = {'manifest': entry['manifest']}
 
+        if updated != inventory:
+            cls.save_inventory(updated)
         return machines
 
+    @staticmethod
+    def load_inventory():
+        try:
+            with open(config['container_inventory']) as f:
+                return json.loads(f.read())
+        except (OSError, ValueError):
+            return {}
+
+    @staticmethod
+    def save_inventory(inventory):
+        directory = os.path.dirname(config['container_inventory'])
+        try:
+            os.makedirs(directory, exist_ok=True)
+            with NamedTemporaryFile('w', dir=directory, delete=False) as f:
+                f.write(json.dumps(inventory))
+            os.rename(f.name, config['container_inventory'])
+        except OSError:
+            pass  # The inventory is only a cache
+
     def exists(self):
         return self.manifest_path().exists()
 
@@ -54,6 +94,7 @@ class BaseContainer:
     def manifest(self, manifest):
         with self.manifest_path().open('w') as f:
             f.write(json.dumps(manifest, indent=2))
+        graph.update(self.name, manifest.get('dependencies', []))
         return manifest
 
 
@@ -0,0 +1,288 @@
+import hashlib
+import mmap
+import os
+import shlex
+import shutil
+import stat
+import subprocess
+import tarfile
+from concurrent.futures import ProcessPoolExecutor
+from tempfile import mkdtemp
+from .config import config
+from . import compression as compressions
+from . import layer_cache
+from . import metadata
+from .lock import store_lock
+from .oci import Image, Blob, Layer, DownloadError, tree_size
+from .tar import WHITEOUT_PREFIX, OPAQUE_WHITEOUT, restore_whiteouts
+
+# Blobs are checked against their digests and extracted layers against the
+# file list of their blobs, in worker processes and without locking the store.
+# What was found intact is stamped in the metadata index: blobs with their
+# size and ctime, layers with the metadata of every file in them. The next
+# run only checks blobs and layers that are new or changed since.
+
+
+def hash_file(path, alg):
+    sha = hashlib.new(alg)
+    with open(path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size > 0:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+                if hasattr(data, 'madvise'):
+                    data.madvise(mmap.MADV_SEQUENTIAL)
+                sha.update(data)
+    return sha.hexdigest()
+
+
+def blob_stamp(path):
+    st = os.stat(str(path))
+    return '{}:{}'.format(st.st_size, st.st_ctime_ns)
+
+
+def check_blob(path, alg, digest):
+    '''Returns what's wrong with the blob, or None'''
+    try:
+        actual = hash_file(path, alg)
+    except (OSError, ValueError) as e:
+        return str(e)
+    if actual != digest:
+        return 'digest mismatch: got {}:{}'.format(alg, actual)
+
+
+def _matches(member, st):
+    '''Whether an extracted file looks like the tar member it came from'''
+    if member.isreg():
+        return stat.S_ISREG(st.st_mode) and st.st_size == member.size
+    if member.isdir():
+        return stat.S_ISDIR(st.st_mode)
+    if member.issym():
+        return stat.S_ISLNK(st.st_mode)
+    return True  # Hardlinks and device files
+
+
+def check_layer(fs_path, blob_path, decompress_command):
+    '''Returns what's missing from an extracted layer, or None'''
+    missing = []
+    try:
+        with open(blob_path, 'rb') as f:
+            decompressor = subprocess.Popen(decompress_command, stdin=f, stdout=subprocess.PIPE)
+        try:
+            with tarfile.open(fileobj=decompressor.stdout, mode='r|') as tar:
+                for member in tar:
+                    dirname, basename = os.path.split(os.path.normpath(member.name))
+                    if basename == OPAQUE_WHITEOUT:
+                        continue  # Extracted as an xattr of the directory
+                    path = os.path.join(dirname, basename)
+                    if basename.startswith(WHITEOUT_PREFIX):
+                        path = os.path.join(dirname, basename[len(WHITEOUT_PREFIX):])
+                        if not os.path.lexists(os.path.join(fs_path, path)):
+                            missing.append(path)
+                        continue
+                    try:
+                        st = os.lstat(os.path.join(fs_path, path))
+                    except FileNotFoundError:
+                        missing.append(path)
+                        continue
+                    if not _matches(member, st):
+                        missing.append(path)  # Left truncated or replaced
+            for _ in iter(lambda: decompressor.stdout.read(1024 * 1024), b''):
+                pass  # Padding after the end of the archive
+        finally:
+            decompressor.stdout.close()
+            decompressor.wait()
+    except (OSError, tarfile.TarError) as e:
+        return 'cannot read its blob: {}'.format(e)
+    if decompressor.returncode != 0:
+        return 'cannot read its blob: {} exited with {}'.format(decompress_command[0], decompressor.returncode)
+    if len(missing) > 0:
+        return '{} files are missing or incomplete, including {}'.format(len(missing), missing[0])
+
+
+def layer_stamp(fs_path):
+    try:
+        return layer_cache.fingerprint([fs_path])
+    except OSError:
+        return None
+
+
+def _check(job):
+    kind, args = job
+    if kind == 'blob':
+        return check_blob(*args)
+    return check_layer(*args)
+
+
+def _entries(root):
+    '''(name, path) of everything stored under root/<alg>/<digest>, skipping
+       temporary files, which `kostka image gc` removes'''
+    if not root.exists():
+        return
+    for alg in sorted(root.iterdir()):
+        if alg.name.startswith('tmp') or not alg.is_dir():
+            continue
+        for path in sorted(alg.iterdir()):
+            if not path.name.startswith('tmp'):
+                yield '{}:{}'.format(alg.name, path.name), path
+
+
+def is_mounted(path):
+    '''Whether path is used by a mount, e.g. as a lowerdir of a running container'''
+    path = str(path)
+    with open('/proc/self/mounts') as f:
+        for line in f:
+            for field in line.split()[:4]:
+                for option in field.split(','):
+                    if path in option.split('=', 1)[-1].split(':'):
+                        return True
+    return False
+
+
+def check(repair=False, check_all=False, force=False, workers=None, progress=print):
+    '''Verifies the image store, and repairs it if asked to.
+       Returns the number of problems left.'''
+    media_types = {}
+    for image in Image:
+        try:
+            image.load()
+        except (OSError, ValueError, KeyError, IndexError):
+            continue  # Reported below
+        for layer in image.layers:
+            media_types[layer.name] = layer.media_type
+
+    with ProcessPoolExecutor(max_workers=workers or os.cpu_count()) as executor:
+        # (size, kind, name, check arguments, stamp)
+        jobs = []
+        skipped = 0
+        verified = metadata.verified('blob')
+        for name, path in _entries(Blob.root):
+            try:
+                stamp = blob_stamp(path)
+            except FileNotFoundError:
+                continue  # Removed by gc in the meantime
+            if not check_all and verified.get(name) == stamp:
+                skipped += 1
+                continue
+            alg, digest = name.split(':', 1)
+            jobs.append((path.stat().st_size, 'blob', name, (str(path), alg, digest), stamp))
+
+        # Walking the layers is cheap compared to reading their blobs, but it
+        # still touches every file, so it's spread over the workers as well
+        verified = metadata.verified('layer')
+        layers = list(_entries(Layer.root))
+        unchecked_layers = 0
+        for (name, path), stamp in zip(layers, executor.map(layer_stamp, [path for name, path in layers])):
+            if stamp is None:
+                continue
+            if not check_all and verified.get(name) == stamp:
+                skipped += 1
+                continue
+            layer = Layer(name, media_type=media_types.get(name, compressions.GZIP_MEDIA_TYPE))
+            if not layer.path.exists():
+                unchecked_layers += 1  # The blob wasn't kept (keep_layer_blobs)
+                continue
+            decompressor = compressions.for_media_type(layer.media_type).decompress_program()
+            jobs.append((len(layer), 'layer', name, (str(path), str(layer.path),
+                                                     shlex.split(decompressor) + ['-d', '-c']), stamp))
+
+        # The biggest files first, so that no worker is left with one at the end
+        jobs.sort(key=lambda job: -job[0])
+        progress('Checking {} blobs and layers, {} were verified before'.format(len(jobs), skipped))
+
+        problems = []
+        results = executor.map(_check, [(kind, args) for size, kind, name, args, stamp in jobs])
+        for (size, kind, name, args, stamp), problem in zip(jobs, results):
+            if problem is not None:
+                progress('Corrupt {} {}: {}'.format(kind, name, problem))
+                problems.append((kind, name))
+            elif kind == 'blob':
+                # Blobs are content-addressed, so one with the same size and
+                # ctime as the one that was checked is the same file
+                with store_lock():
+                    try:
+                        if blob_stamp(args[0]) == stamp:
+                            metadata.set_verified(kind, name, stamp)
+                    except FileNotFoundError:
+                        pass
+            else:
+                # A layer that changed during the check gets a different stamp next time
+                with store_lock():
+                    metadata.set_verified(kind, name, stamp)
+
+    # Links from images to blobs that don't exist anymore
+    for name in sorted(Image._subdirs(Image.root)):
+        for version in sorted(Image._subdirs(name)):
+            if version.name.startswith('.'):
+                continue  # Being uploaded
+            image = '{}:{}'.format(name.name, version.name)
+            if not (version / 'index.json').exists():
+                progress('Image {} has no index.json'.format(image))
+                problems.append(('image', image))
+            for blob_name, link in _entries(version / 'blobs'):
+                if link.exists() or ('blob', blob_name) in problems:
+                    continue
+                if blob_name in media_types and (not config['keep_layer_blobs'] or
+                                                 Layer(blob_name).fs_path.exists()):
+                    continue  # A layer blob that wasn't kept after extraction
+                progress('Image {} links to missing blob {}'.format(image, blob_name))
+                problems.append(('blob', blob_name))
+
+    if unchecked_layers > 0:
+        progress('{} extracted layers were not checked, their blobs are not in the store'.format(unchecked_layers))
+    if not repair:
+        return len(problems)
+
+    left = 0
+    with store_lock():
+        # Blobs first, layers may need them to be extracted again
+        for kind, name in sorted(problems):
+            try:
+                if kind == 'blob':
+                    repair_blob(name)
+                elif kind == 'layer':
+                    repair_layer(Layer(name, media_type=media_types.get(name, compressions.GZIP_MEDIA_TYPE)),
+                                 force)
+                else:
+                    raise ValueError('remove it with `kostka image rm` and download it again')
+                progress('Repaired {} {}'.format(kind, name))
+            except (OSError, ValueError, KeyError, DownloadError, subprocess.CalledProcessError) as e:
+                progress('Cannot repair {} {}: {}'.format(kind, name, e))
+                left += 1
+    return left
+
+
+def repair_blob(name):
+    blob = Blob(name)
+    used = name in metadata.used_blobs()
+    if used and not config['image_hub']:
+        raise KeyError('Image hub not configured. Cannot download the blob again.')
+    if blob.path.exists():
+        blob.path.unlink()
+    metadata.remove_blob(name)
+    if used:
+        blob.download(progressbar=False)
+
+
+def repair_layer(layer, force=False):
+    '''Extracts the layer again next to the broken one and swaps them'''
+    if is_mounted(layer.fs_path) and not force:
+        raise ValueError('it is mounted by a running container. Stop the container, '
+                         'or use --force and restart it afterwards')
+    layer.download(progressbar=False)
+    dest = layer._extract_dir()
+    try:
+        with layer.path.open('rb') as f:
+            subprocess.check_call(layer.untar_command(dest), stdin=f)
+        restore_whiteouts(dest)
+    except:
+        shutil.rmtree(dest, ignore_errors=True)
+        raise
+
+    # The broken layer is moved to a temporary directory (which gc removes if
+    # this is interrupted), because a directory can't be renamed over another one
+    old = mkdtemp(dir=str(layer.fs_path.parent))
+    os.rename(str(layer.fs_path), os.path.join(old, 'layer'))
+    os.rename(dest, str(layer.fs_path))
+    metadata.remove_layer(layer.name)
+    metadata.set_extracted(layer.name, tree_size(layer.fs_path))
+    if not force:
+        shutil.rmtree(old)
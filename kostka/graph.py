@@ -0,0 +1,163 @@
+import fcntl
+import json
+import os
+import threading
+from contextlib import contextmanager
+from tempfile import NamedTemporaryFile
+from .config import config
+
+# Reverse dependencies of containers, so that finding the children of a
+# container doesn't need to read the manifest of every other container.
+#
+# The graph is kept up to date whenever kostka writes a manifest or removes a
+# container. If manifests are changed in some other way, it can be rebuilt
+# with `kostka graph --rebuild`.
+#
+# Nodes are container names, container forks ('name/overlay.fs-N') and
+# images ('image:name:version'). 'dependencies' maps every container to the
+# nodes it uses, 'children' maps containers and images to the containers that
+# use them, no matter which fork of them they use.
+
+_lock = threading.Lock()
+
+
+def node(dependency):
+    if 'image' in dependency:
+        return 'image:{}:{}'.format(dependency['image'], dependency['version'])
+    if ':' in dependency['imageName']:
+        return 'image:' + dependency['imageName']
+    if 'path' in dependency:
+        return '{}/{}'.format(dependency['imageName'], dependency['path'])
+    return dependency['imageName']
+
+
+def parent(node):
+    '''The container or image that a node belongs to'''
+    if node.startswith('image:'):
+        return node
+    return node.split('/', 1)[0]
+
+
+def _load():
+    try:
+        with open(config['container_graph']) as f:
+            return json.loads(f.read())
+    except (OSError, ValueError):
+        return None
+
+
+def _save(graph):
+    directory = os.path.dirname(config['container_graph'])
+    with NamedTemporaryFile('w', dir=directory, delete=False) as f:
+        f.write(json.dumps(graph, sort_keys=True))
+    os.rename(f.name, config['container_graph'])
+
+
+def _add(graph, name, nodes):
+    graph['dependencies'][name] = nodes
+    for dep in set(map(parent, nodes)):
+        children = graph['children'].setdefault(dep, [])
+        if name not in children:
+            children.append(name)
+            children.sort()
+
+
+def _remove(graph, name):
+    for dep in set(map(parent, graph['dependencies'].pop(name, []))):
+        children = graph['children'].get(dep, [])
+        if name in children:
+            children.remove(name)
+        if len(children) == 0:
+            graph['children'].pop(dep, None)
+
+
+def _build():
+    from .container import Container
+    graph = {'dependencies': {}, 'children': {}}
+    for container in Container.all():
+        _add(graph, container.name, [node(dep) for dep in container.manifest.get('dependencies', [])])
+    return graph
+
+
+@contextmanager
+def _locked():
+    '''Serializes changes to the graph between threads and processes'''
+    directory = os.path.dirname(config['container_graph'])
+    os.makedirs(directory, exist_ok=True)
+    with _lock, open(config['container_graph'] + '.lock', 'a') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        yield
+
+
+def load():
+    graph = _load()
+    if graph is None:
+        with _locked():
+            graph = _load()
+            if graph is None:
+                graph = _build()
+                _save(graph)
+    return graph
+
+
+def rebuild():
+    with _locked():
+        graph = _build()
+        _save(graph)
+    return graph
+
+
+def update(name, dependencies):
+    '''Records new dependencies of a container'''
+    nodes = [node(dep) for dep in dependencies]
+    with _locked():
+        graph = _load()
+        if graph is None:
+            graph = _build()
+        _remove(graph, name)
+        _add(graph, name, nodes)
+        _save(graph)
+
+
+def remove(name):
+    with _locked():
+        graph = _load()
+        if graph is None:
+            graph = _build()
+        _remove(graph, name)
+        _save(graph)
+
+
+def dependencies(name, graph=None):
+    return (graph or load())['dependencies'].get(name, [])
+
+
+def children(name, graph=None):
+    '''Containers that directly use a container or an image'''
+    return (graph or load())['children'].get(name, [])
+
+
+def ancestors(name, graph=None):
+    '''Everything a container uses, directly or not, closest first'''
+    graph = graph or load()
+    result = []
+    pending = [name]
+    while len(pending) > 0:
+        for dep in dependencies(pending.pop(0), graph):
+            if dep not in result:
+                result.append(dep)
+                pending.append(parent(dep))
+    return result
+
+
+def descendants(name, graph=None):
+    '''Containers that use a container or an image, directly or not'''
+    graph = graph or load()
+    result = []
+    pending = [name]
+    while len(pending) > 0:
+        for child in children(pending.pop(0), graph):
+            if child not in result:
+                result.append(child)
+                pending.append(child)
+    return result
@@ -0,0 +1,128 @@
+import json
+import os
+import threading
+import time
+from tempfile import NamedTemporaryFile
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from .config import config
+from . import trace
+
+
+class HubSession(requests.Session):
+    def __init__(self, retries=True):
+        super().__init__()
+        retry = Retry(
+            total=config['hub_retries'] if retries else 0,
+            backoff_factor=config['hub_backoff_factor'],
+            status_forcelist=(500, 502, 503, 504),
+            raise_on_status=False,
+        )
+        # The pool has to be big enough for all the parallel layer downloads
+        pool_size = max(10, config['download_workers'])
+        adapter = HTTPAdapter(max_retries=retry, pool_connections=pool_size, pool_maxsize=pool_size)
+        self.mount('http://', adapter)
+        self.mount('https://', adapter)
+
+    def request(self, method, url, *args, **kwargs):
+        if 'timeout' not in kwargs:
+            kwargs['timeout'] = (config['hub_connect_timeout'], config['hub_read_timeout'])
+        with trace.span('{} {}'.format(method, url), 'http') as span:
+            response = super().request(method, url, *args, **kwargs)
+            span['status'] = response.status_code
+            return response
+
+
+_sessions = {}
+_session_lock = threading.Lock()
+
+
+def session(retries=True):
+    with _session_lock:
+        if retries not in _sessions:
+            _sessions[retries] = HubSession(retries)
+        return _sessions[retries]
+
+
+def get(url, **kwargs):
+    return session().get(url, **kwargs)
+
+
+def head(url, **kwargs):
+    return session().head(url, **kwargs)
+
+
+def put(url, **kwargs):
+    # A retry would send the rest of a file that was partly read already,
+    # callers have to retry with the file opened again
+    return session(retries=False).put(url, **kwargs)
+
+
+class Offline(Exception):
+    pass
+
+
+_cache_lock = threading.Lock()
+
+# Mutable documents are kept after hub_cache_ttl, for offline mode and to be
+# revalidated with their ETag, but not forever
+_MAX_AGE = 7 * 24 * 3600
+
+
+def _load_cache():
+    try:
+        with open(config['hub_cache']) as f:
+            return json.loads(f.read())
+    except (OSError, ValueError):
+        return {}  # It's only a cache
+
+
+def _save_entry(url, entry):
+    with _cache_lock:
+        cache = _load_cache()
+        cache[url] = entry
+        now = time.time()
+        cache = {key: cached for key, cached in cache.items()
+                 if cached['immutable'] or now - cached['fetched'] < _MAX_AGE}
+        directory = os.path.dirname(config['hub_cache'])
+        os.makedirs(directory, exist_ok=True)
+        with NamedTemporaryFile('w', dir=directory, delete=False) as f:
+            f.write(json.dumps(cache, sort_keys=True))
+        os.chmod(f.name, 0o644)
+        os.rename(f.name, config['hub_cache'])
+
+
+def get_json(url, immutable=lambda document: False):
+    '''Returns the JSON document at url, cached in hub_cache. Documents for
+       which immutable() is true are never fetched again, others are used
+       for hub_cache_ttl seconds and then revalidated with their ETag or
+       Last-Modified. Raises requests.HTTPError for error responses, and
+       Offline if the document isn't cached in offline mode.'''
+    entry = _load_cache().get(url)
+    if entry is not None and (entry['immutable'] or config['offline'] or
+                              time.time() - entry['fetched'] < config['hub_cache_ttl']):
+        return entry['document']
+    if config['offline']:
+        raise Offline(url)
+
+    headers = {}
+    if entry is not None and entry.get('etag'):
+        headers['If-None-Match'] = entry['etag']
+    if entry is not None and entry.get('last_modified'):
+        headers['If-Modified-Since'] = entry['last_modified']
+    with get(url, headers=headers) as response:
+        if response.status_code == 304 and entry is not None:
+            entry['fetched'] = time.time()
+        else:
+            response.raise_for_status()
+            document = response.json()
+            entry = {
+                'document': document,
+                'etag': response.headers.get('etag'),
+                'last_modified': response.headers.get('last-modified'),
+                'fetched': time.time(),
+                'immutable': bool(immutable(document)),
+            }
+    _save_entry(url, entry)
+    return entry['document']
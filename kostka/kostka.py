@@ -2,12 +2,8 @@
 
 from . import utils
 import os
-from .commands import *  # noqa
-import pkg_resources
-
-for ep in pkg_resources.iter_entry_points(group='kostka'):
-    ep.load()
 
+# Commands and plugins are loaded when they are used, see utils.LazyGroup
 cli = utils.cli
 os.chdir(os.path.dirname(utils.__file__))
 
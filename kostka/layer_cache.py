@@ -0,0 +1,54 @@
+import fcntl
+import hashlib
+import json
+import os
+from tempfile import NamedTemporaryFile
+from .config import config
+
+
+def fingerprint(directories, *key):
+    '''Hashes the metadata of every file in the directories. Any change to a file
+       changes its ctime, so this is enough to tell that a tree didn't change
+       without reading its contents.'''
+    sha = hashlib.sha256(json.dumps([str(d) for d in directories] + list(key)).encode('utf-8'))
+    for directory in directories:
+        directory = str(directory)
+        for dirpath, dirnames, filenames in os.walk(directory):
+            dirnames.sort()
+            names = [''] if dirpath == directory else []
+            for name in names + sorted(dirnames + filenames):
+                path = os.path.join(dirpath, name)
+                st = os.lstat(path)
+                sha.update(json.dumps([
+                    os.path.relpath(path, directory), st.st_ino, st.st_mode, st.st_uid, st.st_gid,
+                    st.st_size, st.st_mtime_ns, st.st_ctime_ns, st.st_rdev,
+                ]).encode('utf-8', 'surrogateescape'))
+    return sha.hexdigest()
+
+
+def load():
+    try:
+        with open(config['layer_cache']) as f:
+            return json.loads(f.read())
+    except (FileNotFoundError, ValueError):
+        return {}
+
+
+def get(key):
+    return load().get(key)
+
+
+def put(key, entry):
+    directory = os.path.dirname(config['layer_cache'])
+    os.makedirs(directory, exist_ok=True)
+    # Images created at the same time would otherwise drop each other's entries
+    with open(config['layer_cache'] + '.lock', 'a') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        cache = load()
+        cache[key] = entry
+        # Entries of blobs removed by `kostka image gc` can't be used anymore
+        cache = {name: cached for name, cached in cache.items()
+                 if os.path.exists(os.path.join(config['blob_root'], *cached['digest'].split(':', 1)))}
+        with NamedTemporaryFile('w', dir=directory, delete=False) as f:
+            f.write(json.dumps(cache, indent=2, sort_keys=True))
+        os.rename(f.name, config['layer_cache'])
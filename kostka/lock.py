@@ -0,0 +1,42 @@
+import fcntl
+import os
+import sys
+import threading
+from contextlib import contextmanager
+from .config import config
+
+# Locks are per thread, so that threads don't release each other's lock
+_local = threading.local()
+
+
+@contextmanager
+def store_lock(exclusive=False):
+    '''Locks the image store. Everything that adds to the store takes a shared
+       lock, `kostka image gc` takes an exclusive one. Nested locks taken by
+       the same process are no-ops.'''
+    depth = getattr(_local, 'depth', 0)
+    if depth > 0:
+        _local.depth = depth + 1
+        try:
+            yield
+        finally:
+            _local.depth -= 1
+        return
+
+    try:
+        os.makedirs(os.path.dirname(config['lock_path']))
+    except FileExistsError:
+        pass
+
+    with open(config['lock_path'], 'a') as f:
+        mode = fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH
+        try:
+            fcntl.flock(f, mode | fcntl.LOCK_NB)
+        except BlockingIOError:
+            print('Waiting for another kostka process to release {}'.format(config['lock_path']), file=sys.stderr)
+            fcntl.flock(f, mode)
+        _local.depth = 1
+        try:
+            yield
+        finally:
+            _local.depth = 0
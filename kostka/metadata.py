@@ -0,0 +1,196 @@
+import os
+import sqlite3
+import time
+from contextlib import contextmanager
+from .config import config
+
+# The index only caches what is stored in image_root, blob_root and layer_root,
+# and can always be rebuilt from them with `kostka image reindex`.
+
+SCHEMA_VERSION = 3
+TABLES = ('images', 'image_layers', 'image_blobs', 'blobs', 'layers', 'verified')
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS images (
+    name TEXT NOT NULL,
+    version TEXT NOT NULL,
+    image_version TEXT NOT NULL,
+    manifest TEXT NOT NULL,
+    PRIMARY KEY (name, version)
+);
+CREATE TABLE IF NOT EXISTS image_layers (
+    name TEXT NOT NULL,
+    version TEXT NOT NULL,
+    position INTEGER NOT NULL,
+    digest TEXT NOT NULL,
+    diff_id TEXT NOT NULL,
+    media_type TEXT NOT NULL,
+    PRIMARY KEY (name, version, position)
+);
+CREATE TABLE IF NOT EXISTS image_blobs (
+    name TEXT NOT NULL,
+    version TEXT NOT NULL,
+    digest TEXT NOT NULL,
+    PRIMARY KEY (name, version, digest)
+);
+CREATE INDEX IF NOT EXISTS image_blobs_digest ON image_blobs (digest);
+CREATE TABLE IF NOT EXISTS blobs (
+    digest TEXT PRIMARY KEY,
+    size INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS layers (
+    digest TEXT PRIMARY KEY,
+    size INTEGER,
+    extracted_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS verified (
+    kind TEXT NOT NULL,
+    digest TEXT NOT NULL,
+    stamp TEXT NOT NULL,
+    verified_at REAL NOT NULL,
+    PRIMARY KEY (kind, digest)
+);
+'''
+
+
+def _connect():
+    directory = os.path.dirname(config['metadata_index'])
+    try:
+        os.makedirs(directory)
+    except FileExistsError:
+        pass
+
+    db = sqlite3.connect(config['metadata_index'], timeout=60)
+    if db.execute('PRAGMA user_version').fetchone()[0] != SCHEMA_VERSION:
+        db.execute('PRAGMA journal_mode=WAL')
+        # The index of an older kostka is rebuilt from scratch
+        for table in TABLES:
+            db.execute('DROP TABLE IF EXISTS {}'.format(table))
+        db.executescript(SCHEMA)
+        db.execute('PRAGMA user_version = {}'.format(SCHEMA_VERSION))
+        db.commit()
+        # The index is new, fill it with whatever is already on disk
+        from .oci import Image
+        Image.reindex()
+    return db
+
+
+@contextmanager
+def transaction():
+    db = _connect()
+    try:
+        with db:
+            yield db
+    finally:
+        db.close()
+
+
+def add_image(name, version, image_version, manifest, layers, blobs):
+    '''layers is a list of (digest, diff_id, media_type) tuples, blobs is a
+       list of digests of all blobs linked from the image's blobs directory'''
+    with transaction() as db:
+        _add_image(db, name, version, image_version, manifest, layers, blobs)
+
+
+def _add_image(db, name, version, image_version, manifest, layers, blobs):
+    _remove_image(db, name, version)
+    db.execute('INSERT INTO images VALUES (?, ?, ?, ?)', (name, version, image_version, manifest))
+    db.executemany('INSERT INTO image_layers VALUES (?, ?, ?, ?, ?, ?)', [
+        (name, version, position, digest, diff_id, media_type)
+        for position, (digest, diff_id, media_type) in enumerate(layers)
+    ])
+    db.executemany('INSERT OR IGNORE INTO image_blobs VALUES (?, ?, ?)',
+                   [(name, version, digest) for digest in blobs])
+
+
+def remove_image(name, version):
+    with transaction() as db:
+        _remove_image(db, name, version)
+
+
+def _remove_image(db, name, version):
+    for table in ('images', 'image_layers', 'image_blobs'):
+        db.execute('DELETE FROM {} WHERE name = ? AND version = ?'.format(table), (name, version))
+
+
+def image(name, version):
+    '''Returns (image_version, manifest, layers) of an image, or None if it's not indexed'''
+    with transaction() as db:
+        row = db.execute('SELECT image_version, manifest FROM images WHERE name = ? AND version = ?',
+                         (name, version)).fetchone()
+        if row is None:
+            return None
+        layers = db.execute('SELECT digest, diff_id, media_type FROM image_layers '
+                            'WHERE name = ? AND version = ? ORDER BY position', (name, version)).fetchall()
+        return row[0], row[1], layers
+
+
+def images():
+    with transaction() as db:
+        return db.execute('SELECT name, version FROM images ORDER BY name, version').fetchall()
+
+
+def used_blobs():
+    with transaction() as db:
+        return set(row[0] for row in db.execute('SELECT DISTINCT digest FROM image_blobs'))
+
+
+def add_blob(digest, size):
+    with transaction() as db:
+        db.execute('INSERT OR REPLACE INTO blobs VALUES (?, ?)', (digest, size))
+
+
+def remove_blob(digest):
+    with transaction() as db:
+        db.execute('DELETE FROM blobs WHERE digest = ?', (digest,))
+        db.execute("DELETE FROM verified WHERE kind = 'blob' AND digest = ?", (digest,))
+
+
+def blobs():
+    '''Returns a {digest: size} dict of all blobs in the store'''
+    with transaction() as db:
+        return dict(db.execute('SELECT digest, size FROM blobs'))
+
+
+def set_extracted(digest, size=None):
+    '''size is the space the extracted layer takes, as counted by tree_size()'''
+    with transaction() as db:
+        db.execute('INSERT OR REPLACE INTO layers VALUES (?, ?, ?)', (digest, size, time.time()))
+
+
+def remove_layer(digest):
+    with transaction() as db:
+        db.execute('DELETE FROM layers WHERE digest = ?', (digest,))
+        db.execute("DELETE FROM verified WHERE kind = 'layer' AND digest = ?", (digest,))
+
+
+def extracted_layers():
+    '''Returns a {digest: size} dict of the extracted layers, size is None
+       for layers that were indexed by `kostka image reindex`'''
+    with transaction() as db:
+        return dict(db.execute('SELECT digest, size FROM layers'))
+
+
+def verified(kind):
+    '''Returns {digest: stamp} of the blobs or layers (kind) that
+       `kostka image fsck` found intact. The stamp identifies the version of
+       the file or tree that was checked.'''
+    with transaction() as db:
+        return dict(db.execute('SELECT digest, stamp FROM verified WHERE kind = ?', (kind,)))
+
+
+def set_verified(kind, digest, stamp):
+    with transaction() as db:
+        db.execute('INSERT OR REPLACE INTO verified VALUES (?, ?, ?, ?)', (kind, digest, stamp, time.time()))
+
+
+def rebuild(images, blobs, layers):
+    '''Replaces the whole index. images is a list of add_image() argument tuples,
+       blobs a {digest: size} dict and layers a list of extracted layer digests.'''
+    with transaction() as db:
+        for table in ('images', 'image_layers', 'image_blobs', 'blobs', 'layers'):
+            db.execute('DELETE FROM {}'.format(table))
+        for args in images:
+            _add_image(db, *args)
+        db.executemany('INSERT INTO blobs VALUES (?, ?)', blobs.items())
+        now = time.time()
+        db.executemany('INSERT INTO layers VALUES (?, ?, ?)', [(digest, None, now) for digest in layers])
@@ -1,39 +1,46 @@
+import atexit
 import click
 import os
+import stat
 import sys
+import json
 import subprocess
-from configparser import SafeConfigParser
+import io
+import threading
+from configparser import ConfigParser
+from tempfile import NamedTemporaryFile
 from toposort import toposort_flatten
-from .oci import Image
-
-
-def escape_path(path):
-    cmd = ['systemd-escape', '-p', str(path)]
-    return subprocess.check_output(cmd).strip().decode('utf-8')
+from .config import config
+from . import clone
+from .systemd import escape_path, write_unit, backend as systemd_backend, SystemdError
 
 
 @click.option("--template", "-t", help="Container to use as a base filesystem. Deprecated - use --image instead.")
 @click.option("--image", "-i", help="Image to use as a base filesystem.")
 def create(ctx, container, template, image, **kwargs):
-    os.mkdir("/var/lib/machines/{}/fs".format(container.name))
+    os.mkdir(str(container.path / 'fs'))
     container.dependencies = []
     if image is not None:
+        from .oci import Image
         for dep in image.split(','):
             if ':' not in dep:
                 dep += ':latest'
 
             name, version = dep.split(':')
-            index = Image.download_index(name, version)
-            version = index['annotations']['kostka.image.version']
+            local = Image(name, version)
+            if not local.path.exists() or local.version != version:
+                # Ask the hub unless this exact version has already been downloaded
+                index = Image.download_index(name, version)
+                version = index['annotations']['kostka.image.version']
 
             container.dependencies += [{'image': name, 'version': version}]
     elif template is None:
         return
 
     try:
-        os.mkdir("/var/lib/machines/{}/overlay.fs-1".format(container.name))
+        os.mkdir(str(container.path / 'overlay.fs-1'))
         (container.path / 'overlay.fs').symlink_to(container.path / 'overlay.fs-1')
-        os.mkdir("/var/lib/machines/{}/workdir".format(container.name))
+        os.mkdir(str(container.path / 'workdir'))
     except FileExistsError:
         # The overlay might be left over from a previous container
         pass
@@ -44,14 +51,12 @@ def create(ctx, container, template, image, **kwargs):
 
 def umount(container):
     mount_unit = escape_path(container.path / 'fs') + '.mount'
-    subprocess.call(['/bin/systemctl', 'stop', mount_unit],
-                    stderr=subprocess.DEVNULL,
-                    stdout=subprocess.DEVNULL)
-    mount_active = subprocess.call(['/bin/systemctl', 'is-active', mount_unit],
-                                   stderr=subprocess.DEVNULL,
-                                   stdout=subprocess.DEVNULL) == 0
-
-    if mount_active:
+    try:
+        systemd_backend().stop(mount_unit)
+    except (subprocess.CalledProcessError, SystemdError):
+        pass
+
+    if systemd_backend().is_active(mount_unit):
         print("Unmounting the container's volume failed. Not removing.",
               file=sys.stderr)
         sys.exit(1)
@@ -62,7 +67,7 @@ def umount(container):
 def rm(container):
     mount_unit = umount(container)
     try:
-        os.remove('/etc/systemd/system/{}'.format(mount_unit))
+        os.remove(os.path.join(config['unit_dir'], mount_unit))
     except FileNotFoundError:
         pass
 
@@ -71,13 +76,16 @@ def stop(container):
     umount(container)
 
 
+@click.option("--clone-mode", type=click.Choice(clone.MODES),
+              help="How to copy the overlay: reflink, copy, or auto (reflink if the filesystem supports it).")
 def copy(container, new_container):
     src = os.path.join(container.path, "overlay.fs")
     src = os.readlink(src)
     # We can assume it's overlay.fs-1, because it's a new container
     dest = os.path.join(new_container.path, "overlay.fs-1")
     os.rmdir(dest)
-    subprocess.check_call(['/bin/cp', '-a', src, dest])
+    mode, copied = clone.clone(src, dest, new_container.copy_options.get('clone_mode'))
+    print("Copied the overlay using {}: {} bytes copied.".format(mode, copied))
 
 
 def update_sd_units(container, service, *args):
@@ -88,17 +96,18 @@ def update_sd_units(container, service, *args):
     mount_name = escape_path(name)
 
     # Prepare the overlayfs mount unit
-    mount = SafeConfigParser()
+    mount = ConfigParser()
     mount.optionxform = str
     mount['Unit'] = {
         'Description': 'OverlayFS for {}'.format(name),
         'PartOf': '{}.service'.format(mount_name)
     }
     mount['Mount'] = container.mounts()[0]
-    mount_path = subprocess.check_output(['systemd-escape', '--path', mount['Mount']['Where']]).strip().decode('utf-8')
-    dst_filename = "/etc/systemd/system/{}.mount".format(mount_path)
-    with open(dst_filename, 'w') as f:
-        mount.write(f)
+    mount_path = escape_path(mount['Mount']['Where'])
+    dst_filename = os.path.join(config['unit_dir'], '{}.mount'.format(mount_path))
+    content = io.StringIO()
+    mount.write(content)
+    write_unit(dst_filename, content.getvalue())
 
     unit = service['Unit']
     if 'Requires' not in unit:
@@ -106,8 +115,68 @@ def update_sd_units(container, service, *args):
     if 'After' not in unit:
         unit['After'] = ''
 
-    unit['Requires'] += 'var-lib-machines-{}-fs.mount '.format(mount_name)
-    unit['After'] += 'var-lib-machines-{}-fs.mount '.format(mount_name)
+    unit['Requires'] += '{}.mount '.format(mount_path)
+    unit['After'] += '{}.mount '.format(mount_path)
+
+
+_lowerdir_cache_lock = threading.Lock()
+
+
+def _fingerprint(path):
+    '''Identifies the current version of a file, or the target of a symlink'''
+    try:
+        st = os.lstat(str(path))
+    except OSError:
+        return None
+    if stat.S_ISLNK(st.st_mode):
+        return os.readlink(str(path))
+    return [st.st_ino, st.st_size, st.st_mtime_ns, st.st_ctime_ns]
+
+
+def _read_lowerdir_cache():
+    try:
+        with open(config['lowerdir_cache']) as f:
+            return json.loads(f.read())
+    except (OSError, ValueError):
+        return {}
+
+
+# Loaded once per process, and written once when it exits
+_lowerdir_cache = None
+_lowerdir_cache_changed = {}
+
+
+def load_lowerdir_cache():
+    global _lowerdir_cache
+    if _lowerdir_cache is None:
+        _lowerdir_cache = _read_lowerdir_cache()
+    return _lowerdir_cache
+
+
+def save_lowerdir_cache(name, entry):
+    with _lowerdir_cache_lock:
+        if len(_lowerdir_cache_changed) == 0:
+            atexit.register(write_lowerdir_cache)
+        load_lowerdir_cache()[name] = entry
+        _lowerdir_cache_changed[name] = entry
+
+
+def write_lowerdir_cache():
+    with _lowerdir_cache_lock:
+        # Merged with what other kostka processes wrote in the meantime
+        cache = _read_lowerdir_cache()
+        cache.update(_lowerdir_cache_changed)
+        _lowerdir_cache_changed.clear()
+        cache = {name: entry for name, entry in cache.items()
+                 if os.path.isdir(os.path.join(config['machines_dir'], name))}
+        directory = os.path.dirname(config['lowerdir_cache'])
+        try:
+            os.makedirs(directory, exist_ok=True)
+            with NamedTemporaryFile('w', dir=directory, delete=False) as f:
+                f.write(json.dumps(cache))
+            os.rename(f.name, config['lowerdir_cache'])
+        except OSError:
+            pass  # It's only a cache
 
 
 class MountContainer:
@@ -122,6 +191,7 @@ class MountContainer:
         self.manifest = manifest
 
     def mounts(self):
+        from . import squash
         if len(self.manifest['dependencies']) == 0:
             return []
 
@@ -130,14 +200,14 @@ class MountContainer:
             options = 'lowerdir={initfs}:{dependencies},upperdir={upperdir},workdir={workdir}'
             options = options.format(
                 initfs=self.path / 'init.fs',
-                dependencies=':'.join(self.mount_lowerdirs()),
+                dependencies=':'.join(squash.flatten(self.mount_lowerdirs(), self.max_lowerdirs())),
                 upperdir=self.path / 'overlay.fs',
                 workdir=self.path / 'workdir'
             )
         else:
             options = 'lowerdir={dependencies},upperdir={upperdir},workdir={workdir}'
             options = options.format(
-                dependencies=':'.join(self.mount_lowerdirs()),
+                dependencies=':'.join(squash.flatten(self.mount_lowerdirs(), self.max_lowerdirs())),
                 upperdir=self.path / 'overlay.fs',
                 workdir=self.path / 'workdir'
             )
@@ -148,25 +218,80 @@ class MountContainer:
             'Type': 'overlay'
         }]
 
+    def max_lowerdirs(self):
+        '''How many dependencies can be mounted before they have to be squashed'''
+        if config['max_lowerdirs'] and (self.path / 'init.fs').exists():
+            return max(config['max_lowerdirs'] - 1, 1)
+        return config['max_lowerdirs']
+
     def mount_lowerdirs(self):
+        '''Returns the lowerdirs in mount order.
+
+           The result is cached between runs, together with the manifests,
+           overlay symlinks and image indexes it was resolved from, and used
+           as long as none of them changed.'''
+        entry = load_lowerdir_cache().get(self.name)
+        if entry is not None \
+                and all(_fingerprint(path) == fp for path, fp in entry['sources'].items()) \
+                and all(os.path.isdir(path) for path in entry['lowerdirs']):
+            return entry['lowerdirs']
+
+        sources = {}
+        lowerdirs = [path for path, layer in self.mount_layers(sources)]
+        save_lowerdir_cache(self.name, {'sources': sources, 'lowerdirs': lowerdirs})
+        return lowerdirs
+
+    def mount_layers(self, sources=None, fetch=True):
+        '''Returns (path, layer) pairs of the lowerdirs in mount order.
+           layer is None for directories that are not image layers.
+
+           If sources is given, it's filled with fingerprints of the files
+           that the result depends on. Without fetch, nothing is downloaded
+           or extracted, and KeyError is raised for images that are not in the store.'''
+        # Images are imported here, because most commands don't need them
+        from .oci import Image
+
         # First, build a dependency graph in order to avoid duplicate entries
         dependencies = {}
+        layers = {}
+        if sources is None:
+            sources = {}
+        sources[str(self.manifest_path())] = _fingerprint(self.manifest_path())
 
         def dependency_path(dep):
             if 'image' in dep:
-                return Image.download(dep['image'], dep['version'])
-            if ':' in dep['imageName']:  # It's an image
-                return Image.download(dep['imageName'])
+                name, version = dep['image'], dep['version']
+            elif ':' in dep['imageName']:  # It's an image
+                name, version = dep['imageName'].split(':', 1)
             else:  # It's a container
                 container = self.__class__(dep['imageName'])
+                for path in (container.manifest_path(), container.path / 'overlay.fs'):
+                    sources[str(path)] = _fingerprint(path)
                 path = dep.get('path', str((container.path / 'overlay.fs').resolve()))
                 return os.path.join(dep['imageName'], path)
+            index = Image.root / name / version / 'index.json'
+            if fetch:
+                image = Image.download(name, version, extract=True)
+            elif index.exists():
+                image = Image(name, version).load()
+            else:
+                raise KeyError('Image {}:{} is not in the store'.format(name, version))
+            sources[str(index)] = _fingerprint(index)
+            return image
+
+        def node(path):
+            if isinstance(path, Image):
+                return str(path.layers[-1].fs_path)
+            return path
 
         pending_deps = set(map(dependency_path, self.dependencies))
         while len(pending_deps) > 0:
             path = pending_deps.pop()
             if isinstance(path, Image):
-                path.extract()
+                if fetch:
+                    path.extract()
+                for layer in path.layers:
+                    layers[str(layer.fs_path)] = layer
                 prev_layer = str(path.layers[-1].fs_path)
                 dependencies[prev_layer] = set()
                 for layer in reversed(path.layers[:-1]):
@@ -175,14 +300,15 @@ class MountContainer:
             else:
                 name = path.split('/')[-2]
                 if name not in dependencies:
-                    dependencies[path] = set(map(dependency_path, self.__class__(name).dependencies))
-                    pending_deps |= dependencies[path]
+                    container_deps = set(map(dependency_path, self.__class__(name).dependencies))
+                    dependencies[path] = set(map(node, container_deps))
+                    pending_deps |= container_deps
 
         # Then sort it topologically. The list is reversed, because overlayfs
         # will check the mounts in order they are given, so the base fs has to
         # be the last one.
         dependencies = reversed(list(toposort_flatten(dependencies)))
-        return (os.path.join(self.metadata_dir, dep) for dep in dependencies)
+        return [(os.path.join(self.metadata_dir, dep), layers.get(dep)) for dep in dependencies]
 
     def default_manifest(self):
         super_dict = {}
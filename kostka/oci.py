@@ -1,56 +1,73 @@
 import json
+import os
 from pathlib import Path
 import hashlib
-from tempfile import TemporaryDirectory, NamedTemporaryFile
+from tempfile import NamedTemporaryFile, mkdtemp
+from concurrent.futures import ThreadPoolExecutor
 import platform
 import subprocess
 import shutil
+import threading
 import requests
+from . import hub
 from .config import config
+from .tar import write_tar, restore_whiteouts
+from . import compression as compressions
+from . import layer_cache
+from . import metadata
+from .lock import store_lock
+from . import trace
 
 
 class DownloadError(Exception):
     pass
 
 
+class _RangeIgnored(Exception):
+    '''The server sent the whole blob instead of the rest of it'''
+
+
 class Blob:
     root = Path(config['blob_root'])
 
     @classmethod
-    def from_dirs(cls, *directories):
+    def from_dirs(cls, *directories, compression=None, level=None):
         try:
             (Blob.root / 'sha256').mkdir(parents=True)
         except FileExistsError:
             pass
 
-        with TemporaryDirectory(dir=str(Blob.root)) as dest:
-            for directory in directories:
-                # Using rsync so that devices are also copied
-                subprocess.check_call(['rsync', '-aHAX', str(directory) + '/', str(dest)])
-
-            tar = subprocess.Popen(['tar',
-                '--sort=name', '--numeric-owner',
-                '-cp', '--directory={}'.format(dest),
-                '--mtime=2000-01-01 00:00Z', '.'
-            ], stdout=subprocess.PIPE)
-
-            # We cannot use `tar -z` here, because it won't pass `-n` to gzip,
-            # and as a consequence, won't be deterministic
-            gzip = subprocess.Popen(['gzip', '-n', '-'], stdin=tar.stdout, stdout=subprocess.PIPE)
-            tar.stdout.close()
-
-            with NamedTemporaryFile(dir=str(Blob.root), delete=False) as f:
-                sha = hashlib.sha256()
-                while gzip.stdout.readable():
-                    chunk = gzip.stdout.read(1024 * 1024)
-                    if len(chunk) == 0:
-                        break
-                    f.write(chunk)
-                    sha.update(chunk)
-                digest = sha.hexdigest()
-                tmp_path = f.name
-            shutil.move(tmp_path, str(Blob.root / 'sha256' / digest))
-            return cls('sha256', digest)
+        # The directories are written straight into a tar stream, which is
+        # hashed (to get the diff_id) on its way into the compressor. We cannot
+        # use `tar -z` here, because it won't pass `-n` to gzip, and as a
+        # consequence, won't be deterministic.
+        compression = compressions.get(compression)
+        compressor = subprocess.Popen(compression.compress_command(level),
+                                      stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        with NamedTemporaryFile(dir=str(Blob.root), delete=False) as f:
+            try:
+                compressed = _HashingWriter(f)
+                reader = threading.Thread(target=_copy_pipe, args=(compressor.stdout, compressed))
+                reader.start()
+                uncompressed = _HashingWriter(compressor.stdin)
+                try:
+                    write_tar(uncompressed, *directories)
+                finally:
+                    compressor.stdin.close()
+                    reader.join()
+                    compressor.wait()
+                if compressor.returncode != 0:
+                    raise subprocess.CalledProcessError(compressor.returncode, compressor.args)
+            except:
+                os.unlink(f.name)
+                raise
+        os.chmod(f.name, 0o644)
+        os.rename(f.name, str(Blob.root / 'sha256' / compressed.hexdigest()))
+        blob = cls('sha256', compressed.hexdigest())
+        metadata.add_blob(blob.name, len(blob))
+        blob.diff_id = 'sha256:' + uncompressed.hexdigest()
+        blob.media_type = compression.media_type
+        return blob
 
     @classmethod
     def from_str(cls, content):
@@ -66,6 +83,7 @@ class Blob:
         blob = cls('sha256', sha)
         with blob.path.open('w') as f:
             f.write(content)
+        metadata.add_blob(blob.name, len(blob))
         return blob
 
     def __init__(self, digest_alg, digest=None, root=None):
@@ -76,38 +94,112 @@ class Blob:
         self.digest_alg = digest_alg
         self.digest = digest
 
-    def download(self, progressbar=True):
-        from tqdm import tqdm
+    @property
+    def url(self):
         if not config['image_hub']:
             raise KeyError('Image hub not configured. Cannot download image.')
+        return '{}/blobs/{}/{}'.format(config['image_hub'], self.digest_alg, self.digest)
+
+    def download(self, progressbar=True):
         if self.path.exists():
             return self  # Do nothing if the blob is already downloaded
-        url = '{}/blobs/{}/{}'.format(config['image_hub'], self.digest_alg, self.digest)
-        req = requests.get(url, stream=True)
-        if req.status_code != 200:
-            raise DownloadError('Failed to download {}. Status code: {}'.format(url, req.status_code))
         try:
             self.path.parent.mkdir(parents=True)
         except FileExistsError:
             pass
 
-        total_size = int(req.headers.get('content-length', 0))
+        # The blob is streamed into a temporary file and only moved into place
+        # once its digest is verified, so that an interrupted download never
+        # leaves a truncated blob behind.
+        with NamedTemporaryFile(dir=str(self.root), delete=False) as f:
+            try:
+                self.fetch(f, progressbar)
+            except:
+                os.unlink(f.name)
+                raise
+        os.chmod(f.name, 0o644)
+        os.rename(f.name, str(self.path))
+        metadata.add_blob(self.name, len(self))
+        return self
+
+    def fetch(self, f, progressbar=True):
+        '''Streams the blob from the hub into f, resuming the download after
+           connection failures, and raises DownloadError if the digest doesn't match.'''
+        from tqdm import tqdm
+        url = self.url
+        sha = hashlib.new(self.digest_alg)
+        attempt = 0
+        bar = None
+        if progressbar:
+            bar = tqdm(unit='B', unit_scale=True, leave=False)
         try:
-            if progressbar:
-                progressbar = tqdm(total=total_size, unit='B', unit_scale=True, leave=False)
-            with self.path.open('wb') as f:
-                for chunk in req.iter_content(chunk_size=1024 * 1024):
-                    if progressbar:
-                        progressbar.update(len(chunk))
-                    f.write(chunk)
+            while True:
+                try:
+                    total_size = self._download_range(url, f, sha, bar)
+                    if total_size is None or f.tell() >= total_size:
+                        break
+                    error = 'connection closed after {} of {} bytes'.format(f.tell(), total_size)
+                except _RangeIgnored:
+                    # f was emptied, the download starts again from the beginning
+                    sha = hashlib.new(self.digest_alg)
+                    continue
+                except requests.RequestException as e:
+                    error = e
+                attempt += 1
+                if attempt >= config['download_attempts']:
+                    raise DownloadError('Failed to download {}: {}'.format(url, error))
         finally:
-            if progressbar:
-                progressbar.close()
-        return self
+            if bar is not None:
+                bar.close()
+
+        if sha.hexdigest() != self.digest:
+            raise DownloadError('Failed to download {}. Digest mismatch: got {}:{}'.format(
+                url, self.digest_alg, sha.hexdigest()))
+
+    @staticmethod
+    def _download_range(url, f, sha, bar):
+        offset = f.tell()
+        headers = {}
+        if offset > 0:
+            headers['Range'] = 'bytes={}-'.format(offset)
+        with trace.span('download {}'.format(url), 'http') as span, \
+                hub.get(url, stream=True, headers=headers) as req:
+            span['offset'] = offset
+            if req.status_code == 200 and offset > 0:
+                # The server ignored our Range header, start from scratch
+                if not f.seekable():
+                    raise DownloadError('Cannot resume downloading {}: the server '
+                                        'does not support range requests'.format(url))
+                f.seek(0)
+                f.truncate()
+                if bar is not None:
+                    bar.reset()
+                raise _RangeIgnored()
+            elif req.status_code not in (200, 206):
+                raise DownloadError('Failed to download {}. Status code: {}'.format(url, req.status_code))
+
+            total_size = None
+            if 'content-length' in req.headers:
+                total_size = offset + int(req.headers['content-length'])
+            if bar is not None:
+                bar.total = total_size
+                bar.refresh()
+
+            for chunk in req.iter_content(chunk_size=1024 * 1024):
+                f.write(chunk)
+                sha.update(chunk)
+                if bar is not None:
+                    bar.update(len(chunk))
+            span['bytes'] = f.tell() - offset
+            return total_size
 
     def __len__(self):
         return (self.root / self.digest_alg / self.digest).stat().st_size
 
+    @property
+    def name(self):
+        return '{}:{}'.format(self.digest_alg, self.digest)
+
     @property
     def path(self) -> Path:
         return self.root / self.digest_alg / self.digest
@@ -118,21 +210,164 @@ class Layer(Blob):
 
     @classmethod
     def from_blob(cls, blob: Blob, root=None):
-        return cls(blob.digest_alg, blob.digest, root, blob.root)
+        return cls(blob.digest_alg, blob.digest, root, blob.root, getattr(blob, 'diff_id', None),
+                   getattr(blob, 'media_type', compressions.GZIP_MEDIA_TYPE))
 
-    def __init__(self, digest_alg, digest=None, root=None, blob_root=None):
+    def __init__(self, digest_alg, digest=None, root=None, blob_root=None, diff_id=None,
+                 media_type=compressions.GZIP_MEDIA_TYPE, size=None):
         super().__init__(digest_alg, digest, blob_root)
         self.layer_root = root or Layer.root
+        # Older images used the compressed digest as the diff_id
+        self.diff_id = diff_id or self.digest
+        self.media_type = media_type
+        # Known from the manifest, the blob might not be kept after extraction
+        self.size = size
+
+    def __len__(self):
+        if self.size is not None:
+            return self.size
+        return super().__len__()
 
     @property
     def fs_path(self) -> Path:
         return self.layer_root / self.digest_alg / self.digest
 
+    def untar_command(self, dest):
+        decompressor = compressions.for_media_type(self.media_type).decompress_program()
+        return ['tar', '-x', '--use-compress-program={}'.format(decompressor),
+                '--numeric-owner', '-p', '--xattrs', '--xattrs-include=*',
+                '--directory={}'.format(dest), '-f', '-']
+
     def extract(self):
         if self.fs_path.exists():
             return
-        self.fs_path.mkdir(parents=True)
-        shutil.unpack_archive(str(self.path), str(self.fs_path), 'gztar')
+        if not self.path.exists():
+            # The blob wasn't kept after extraction, and gc removed the extracted layer since
+            self.download_extract(progressbar=False, keep_blob=config['keep_layer_blobs'])
+            return
+        # Extract into a temporary directory first, so that a crash never
+        # leaves a half-extracted layer in fs_path
+        dest = self._extract_dir()
+        try:
+            with self.path.open('rb') as f:
+                subprocess.check_call(self.untar_command(dest), stdin=f)
+            self._install(dest)
+        except:
+            shutil.rmtree(dest, ignore_errors=True)
+            raise
+
+    def download_extract(self, progressbar=True, keep_blob=True):
+        '''Downloads the layer and extracts it while the bytes arrive.
+           The compressed blob is also written to the blob store if keep_blob is set.'''
+        if self.path.exists() or (self.fs_path.exists() and keep_blob):
+            self.download(progressbar)
+            self.extract()
+            return self
+        if self.fs_path.exists():
+            return self
+
+        blob = None
+        if keep_blob:
+            try:
+                self.path.parent.mkdir(parents=True)
+            except FileExistsError:
+                pass
+            blob = NamedTemporaryFile(dir=str(self.root), delete=False)
+
+        dest = self._extract_dir()
+        try:
+            tar = subprocess.Popen(self.untar_command(dest), stdin=subprocess.PIPE)
+            try:
+                self.fetch(_Tee(tar.stdin, blob), progressbar)
+            finally:
+                tar.stdin.close()
+                if tar.wait() != 0:
+                    raise subprocess.CalledProcessError(tar.returncode, tar.args)
+
+            if blob:
+                blob.close()
+                os.chmod(blob.name, 0o644)
+                os.rename(blob.name, str(self.path))
+                metadata.add_blob(self.name, self.path.stat().st_size)
+            self._install(dest)
+        except:
+            shutil.rmtree(dest, ignore_errors=True)
+            if blob:
+                blob.close()
+                try:
+                    os.unlink(blob.name)
+                except FileNotFoundError:
+                    pass
+            raise
+        return self
+
+    def _extract_dir(self):
+        try:
+            self.fs_path.parent.mkdir(parents=True)
+        except FileExistsError:
+            pass
+        return mkdtemp(dir=str(self.fs_path.parent))
+
+    def _install(self, dest):
+        restore_whiteouts(dest)
+        try:
+            os.rename(dest, str(self.fs_path))
+        except OSError:
+            if not self.fs_path.exists():
+                raise
+            # Somebody else has extracted the layer in the meantime
+            shutil.rmtree(dest)
+        metadata.set_extracted(self.name, tree_size(self.fs_path))
+
+
+def tree_size(path):
+    '''Space taken by a file or directory tree, as counted by `kostka image gc`'''
+    size = os.lstat(str(path)).st_size
+    for dirpath, dirnames, filenames in os.walk(str(path)):
+        for name in dirnames + filenames:
+            size += os.lstat(os.path.join(dirpath, name)).st_size
+    return size
+
+
+class _HashingWriter:
+    def __init__(self, f):
+        self.f = f
+        self.sha = hashlib.sha256()
+
+    def write(self, data):
+        self.f.write(data)
+        self.sha.update(data)
+        return len(data)
+
+    def hexdigest(self):
+        return self.sha.hexdigest()
+
+
+def _copy_pipe(src, dest):
+    try:
+        shutil.copyfileobj(src, dest, 1024 * 1024)
+    finally:
+        # If writing failed, this makes the writing end of the pipe fail too
+        # instead of waiting forever
+        src.close()
+
+
+class _Tee:
+    '''A write-only stream that copies everything into all of the given files'''
+    def __init__(self, *files):
+        self.files = [f for f in files if f is not None]
+        self.offset = 0
+
+    def write(self, data):
+        for f in self.files:
+            f.write(data)
+        self.offset += len(data)
+
+    def tell(self):
+        return self.offset
+
+    def seekable(self):
+        return False
 
 
 class ImageMeta(type):
@@ -140,9 +375,8 @@ class ImageMeta(type):
         return (Image.root / item).exists()
 
     def __iter__(self):
-        for directory in Image.root.iterdir():
-            for version in directory.iterdir():
-                yield Image('{}:{}'.format(directory.name, version.name))
+        for name, version in metadata.images():
+            yield Image(name, version)
 
 
 class Image(metaclass=ImageMeta):
@@ -167,21 +401,66 @@ class Image(metaclass=ImageMeta):
         if not hasattr(content, 'digest') and not isinstance(content, str):
             content = json.dumps(content, sort_keys=True)
         return {
-            'mediaType': 'application/vnd.oci.image.{}'.format(type),
+            'mediaType': type if '/' in type else 'application/vnd.oci.image.{}'.format(type),
             'size': len(content),
             'digest': cls.digest(content),
         }
 
+    @staticmethod
+    def manifest_layers(manifest):
+        diff_ids = []
+        if 'config' in manifest and Blob(manifest['config']['digest']).path.exists():
+            with Blob(manifest['config']['digest']).path.open() as f:
+                diff_ids = json.loads(f.read())['rootfs']['diff_ids']
+        if len(diff_ids) != len(manifest['layers']):
+            diff_ids = [None] * len(manifest['layers'])
+        return [Layer(layer['digest'], diff_id=diff_id,
+                      media_type=layer.get('mediaType', compressions.GZIP_MEDIA_TYPE), size=layer.get('size'))
+                for layer, diff_id in zip(manifest['layers'], diff_ids)]
+
     @classmethod
-    def create(cls, name, version=None):
-        return cls(name, version=None, create=True)
+    def create(cls, name, version=None, compression=None, compression_level=None):
+        return cls(name, version=None, create=True,
+                   compression=compression, compression_level=compression_level)
 
     @classmethod
     def delete(cls, name, version=None):
         if version is None:
             name, version = name.split(':', 1)
+        metadata.remove_image(name, version)
         shutil.rmtree(str(cls.root / name / version))
 
+    @classmethod
+    def reindex(cls):
+        '''Rebuilds the metadata index from the image, blob and layer directories'''
+        images = []
+        for directory in cls._subdirs(cls.root):
+            for version in cls._subdirs(directory):
+                try:
+                    image = cls(directory.name, version.name).load_from_disk()
+                except (OSError, ValueError, KeyError, IndexError):
+                    continue  # A broken image, there's nothing to index
+                images.append(image.index_entry(version.name))
+
+        blobs = {}
+        for alg in cls._subdirs(Blob.root):
+            for blob in alg.iterdir():
+                blobs['{}:{}'.format(alg.name, blob.name)] = blob.stat().st_size
+
+        layers = []
+        for alg in cls._subdirs(Layer.root):
+            for layer in cls._subdirs(alg):
+                if not layer.name.startswith('tmp'):  # Extraction in progress
+                    layers.append('{}:{}'.format(alg.name, layer.name))
+
+        metadata.rebuild(images, blobs, layers)
+
+    @staticmethod
+    def _subdirs(path):
+        if not path.exists():
+            return []
+        return [child for child in path.iterdir() if child.is_dir()]
+
     @classmethod
     def download_index(cls, name, version=None):
         if not config['image_hub']:
@@ -189,31 +468,81 @@ class Image(metaclass=ImageMeta):
         if version is None:
             name, version = name.split(':', 1)
         index_url = '{}/images/{}/{}/index.json'.format(config['image_hub'], name, version)
-        with requests.get(index_url) as response:
-            if response.status_code != 200:
-                raise DownloadError('Failed to download {}. Status code: {}'.format(index_url, response.status_code))
-            return response.json()
+
+        def pinned(index):
+            # The index of a version never changes, unlike tags like "latest"
+            return index.get('annotations', {}).get('kostka.image.version') == version
+
+        try:
+            return hub.get_json(index_url, immutable=pinned)
+        except hub.Offline:
+            raise DownloadError('Image {}:{} is not available offline.'.format(name, version))
+        except requests.HTTPError as e:
+            raise DownloadError('Failed to download {}. Status code: {}'.format(
+                index_url, e.response.status_code))
 
     @classmethod
-    def download(cls, name, version=None, progressbar=True):
+    def download(cls, name, version=None, progressbar=True, extract=False):
         if version is None:
             name, version = name.split(':', 1)
-        index = cls.download_index(name, version)
-        if (Image.root / name / version).exists():
-            return cls(name, version).load()
-        with cls(name, version, create=True) as image:
-            manifest = image.blob(Blob(index['manifests'][0]['digest']).download())
-            with manifest.path.open() as f:
-                manifest = json.loads(f.read())
+        with cls._download_lock(name, version), store_lock():
+            # Images that are already in the store are used as they are,
+            # so there's no need to ask the hub about them.
+            if (Image.root / name / version).exists():
+                index = None
+            else:
+                index = cls.download_index(name, version)
+            return cls._download(name, version, index, progressbar, extract)
+
+    _download_locks = {}
+    _download_locks_lock = threading.Lock()
 
-            for layer in manifest['layers']:
-                blob = image.blob(Layer(layer['digest']).download(progressbar))
-                image.layers.append(blob)
+    @classmethod
+    def _download_lock(cls, name, version):
+        '''Makes threads that need the same image wait for one download'''
+        with cls._download_locks_lock:
+            return cls._download_locks.setdefault((name, version), threading.Lock())
 
+    @classmethod
+    def _download(cls, name, version, index, progressbar, extract):
+        if (Image.root / name / version).exists():
+            image = cls(name, version).load()
+            if extract:
+                image.extract()
             return image
 
-    def __init__(self, name, version=None, create=False, root=None):
+        def fetch(layer):
+            if extract and config['stream_layers']:
+                return layer.download_extract(progressbar, keep_blob=config['keep_layer_blobs'])
+            layer.download(progressbar)
+            if extract:
+                layer.extract()
+            return layer
+
+        image = cls(name, version, create=True)
+        try:
+            with image:
+                manifest = image.blob(Blob(index['manifests'][0]['digest']).download())
+                with manifest.path.open() as f:
+                    manifest = json.loads(f.read())
+
+                if 'config' in manifest:
+                    image.blob(Blob(manifest['config']['digest']).download())
+                layers = cls.manifest_layers(manifest)
+                with ThreadPoolExecutor(max_workers=config['download_workers']) as executor:
+                    for layer in executor.map(fetch, layers):
+                        image.layers.append(image.blob(layer))
+
+                return image
+        except:
+            # Don't leave a half-downloaded image behind, it would be trusted later
+            cls.delete(name, version)
+            raise
+
+    def __init__(self, name, version=None, create=False, root=None, compression=None, compression_level=None):
         self.root = root or Image.root
+        self.compression = compression
+        self.compression_level = compression_level
         if version is None:
             name, version = name.split(':', 1)
         self.name = name
@@ -232,19 +561,57 @@ class Image(metaclass=ImageMeta):
                 pass  # Because python 3.4 doesn't have exist_ok in Path.mkdir
 
     def load(self):
+        requested = self._version
+        indexed = metadata.image(self.name, requested)
+        if indexed is not None and not self._indexed_path_valid(requested, indexed[0]):
+            metadata.remove_image(self.name, requested)
+            indexed = None
+        if indexed is None:
+            self.load_from_disk()
+            metadata.add_image(*self.index_entry(self.path.name))
+            if requested != self.path.name:
+                # Also under the alias it was asked for, like "latest"
+                metadata.add_image(*self.index_entry(requested))
+            return self
+
+        self._version, self.manifest_digest, layers = indexed
+        self.path = self.root / self.name / self._version
+        self.layers += [Layer(digest, diff_id=diff_id, media_type=media_type)
+                        for digest, diff_id, media_type in layers]
+        self.loaded = True
+        return self
+
+    def _indexed_path_valid(self, version, image_version):
+        '''Whether the image a version was indexed as is still on disk. An
+           alias has to be a symlink to the version it was indexed as.'''
+        path = self.root / self.name / version
+        target = self.root / self.name / image_version
+        if not target.is_dir():
+            return False
+        return version == image_version or (path.is_symlink() and path.resolve() == target.resolve())
+
+    def load_from_disk(self):
         with (self.path / 'index.json').open() as f:
             index = json.loads(f.read())
         if 'annotations' in index and 'kostka.image.version' in index['annotations']:
             self._version = index['annotations']['kostka.image.version']
             self.path = self.root / self.name / self._version
-        manifest = Blob(index['manifests'][0]['digest'])
+        self.manifest_digest = index['manifests'][0]['digest']
+        manifest = Blob(self.manifest_digest)
         with manifest.path.open() as f:
             manifest = json.loads(f.read())
-        for layer in manifest['layers']:
-            self.layers.append(Layer(layer['digest']))
+        self.layers += self.manifest_layers(manifest)
         self.loaded = True
         return self
 
+    def index_entry(self, version):
+        '''Arguments for metadata.add_image() describing this image'''
+        blobs = []
+        for alg in (self.path / 'blobs').iterdir():
+            blobs += ['{}:{}'.format(alg.name, blob.name) for blob in alg.iterdir()]
+        layers = [(layer.name, layer.diff_id, layer.media_type) for layer in self.layers]
+        return self.name, version, self._version, self.manifest_digest, layers, blobs
+
     @property
     def version(self):
         if not self.loaded:
@@ -272,7 +639,7 @@ class Image(metaclass=ImageMeta):
             'schemaVersion': 2,
             'config': self.descriptor('config.v1+json', self.config),
             'layers': [
-                self.descriptor('layer.v1.tar+gzip', layer)
+                self.descriptor(layer.media_type, layer)
                 for layer in self.layers
             ],
         }
@@ -286,7 +653,7 @@ class Image(metaclass=ImageMeta):
             'os': platform.system().lower(),
             'rootfs': {
                 'type': 'layers',
-                'diff_ids': [layer.digest for layer in self.layers]
+                'diff_ids': [layer.diff_id for layer in self.layers]
             },
         }
 
@@ -296,7 +663,7 @@ class Image(metaclass=ImageMeta):
 
     def blob(self, blob: Blob):
         path = (self.path / 'blobs' / blob.digest_alg / blob.digest)
-        if not path.exists():
+        if not os.path.lexists(str(path)):
             path.symlink_to(blob.path)
         return blob
 
@@ -311,20 +678,50 @@ class Image(metaclass=ImageMeta):
             f.write(json.dumps(self.layout(), sort_keys=True))
         with (self.path / 'index.json').open('w') as f:
             f.write(json.dumps(self.index, sort_keys=True))
+        self.manifest_digest = self.digest(self.manifest)
+        metadata.add_image(*self.index_entry(self.path.name))
 
     def __enter__(self):
+        self._lock = store_lock()
+        self._lock.__enter__()
         return self
 
     def __exit__(self, exc_type, exc_value, traceback):
-        self.write()
+        try:
+            if exc_type is None:
+                self.write()
+        finally:
+            self._lock.__exit__(exc_type, exc_value, traceback)
 
     def add_layer(self, *directories):
         if not self.loaded:
             self.load()
 
-        blob = Layer.from_dirs(*directories)
+        # Unchanged directories reuse the blob built from them last time
+        compression = compressions.get(self.compression)
+        key = layer_cache.fingerprint(directories, compression.name, compression.level(self.compression_level))
+        cached = layer_cache.get(key)
+        if cached and Blob(cached['digest']).path.exists():
+            blob = Layer(cached['digest'], diff_id=cached['diff_id'], media_type=cached['media_type'])
+        else:
+            blob = Layer.from_dirs(*directories, compression=self.compression, level=self.compression_level)
+            layer_cache.put(key, {
+                'digest': self.digest(blob),
+                'diff_id': blob.diff_id,
+                'media_type': blob.media_type,
+            })
         self.blob(blob)
         self.layers.append(blob)
+        return blob
+
+    def add_existing_layer(self, layer):
+        if not self.loaded:
+            self.load()
+
+        layer.download(progressbar=False)  # The blob might not have been kept after extraction
+        self.blob(layer)
+        self.layers.append(layer)
+        return layer
 
     def extract(self):
         '''Extracts layers so they can be used in a container'''
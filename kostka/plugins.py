@@ -1,5 +1,113 @@
+import importlib
+import json
+import os
+import sys
 from functools import wraps
-import pkg_resources
+from tempfile import NamedTemporaryFile
+from .config import config
+from . import trace
+
+
+class EntryPoint:
+    def __init__(self, name, value, dist_name, dist_location):
+        self.name = name
+        self.value = value
+        self.dist_name = dist_name
+        self.dist_location = dist_location
+
+    def load(self):
+        module, _, attrs = self.value.partition(':')
+        obj = importlib.import_module(module.strip())
+        for attr in filter(None, attrs.strip().split('.')):
+            obj = getattr(obj, attr)
+        return obj
+
+
+def _installed():
+    '''Identifies the set of installed distributions: installing or removing
+       one changes the mtime of its directory on sys.path, and reinstalling
+       one in place rewrites its RECORD'''
+    key = []
+    for path in filter(None, sys.path):  # Skip the current directory, which changes between runs
+        try:
+            key.append([path, os.stat(path).st_mtime_ns])
+            entries = sorted(entry.name for entry in os.scandir(path))
+        except OSError:
+            continue
+        for name in entries:
+            if name.endswith('.dist-info'):
+                record = os.path.join(path, name, 'RECORD')
+            elif name.endswith(('.egg-info', '.egg-link')):
+                record = os.path.join(path, name)
+            else:
+                continue
+            try:
+                key.append([record, os.stat(record).st_mtime_ns])
+            except OSError:
+                pass
+    return key
+
+
+def _scan():
+    '''Returns {group: [[name, value, dist_name, dist_location], ...]} for all kostka groups'''
+    groups = {}
+    try:
+        from importlib.metadata import distributions
+    except ImportError:
+        import pkg_resources  # Python < 3.8
+        for dist in pkg_resources.working_set:
+            for group, eps in dist.get_entry_map().items():
+                if group == 'kostka' or group.startswith('kostka.'):
+                    groups.setdefault(group, []).extend(
+                        [ep.name, ':'.join([ep.module_name, '.'.join(ep.attrs)]), dist.key, dist.location]
+                        for ep in eps.values())
+        return groups
+
+    seen = set()
+    for dist in distributions():
+        name = dist.metadata['Name']
+        if name is None:
+            continue  # Broken metadata, e.g. a half-removed distribution
+        name = name.lower()
+        if name in seen:
+            continue  # Shadowed by a distribution earlier on sys.path
+        seen.add(name)
+        for ep in dist.entry_points:
+            if ep.group == 'kostka' or ep.group.startswith('kostka.'):
+                groups.setdefault(ep.group, []).append([ep.name, ep.value, name, str(dist.locate_file(''))])
+    return groups
+
+
+_entry_points = None
+
+
+def entry_points(group):
+    '''Same as pkg_resources.iter_entry_points, but much faster: the entry
+       points are cached on disk until the installed distributions change.'''
+    global _entry_points
+    if _entry_points is None:
+        installed = _installed()
+        try:
+            with open(config['plugin_cache']) as f:
+                cache = json.loads(f.read())
+            if cache['installed'] == installed:
+                _entry_points = cache['groups']
+        except (OSError, ValueError, KeyError):
+            pass
+
+        if _entry_points is None:
+            _entry_points = _scan()
+            try:
+                directory = os.path.dirname(config['plugin_cache'])
+                os.makedirs(directory, exist_ok=True)
+                with NamedTemporaryFile('w', dir=directory, delete=False) as f:
+                    f.write(json.dumps({'installed': installed, 'groups': _entry_points}))
+                os.chmod(f.name, 0o644)
+                os.rename(f.name, config['plugin_cache'])
+            except OSError:
+                pass  # It's only a cache
+    return [EntryPoint(*ep) for ep in _entry_points.get(group, [])]
+
 
 def extensible_command(f):
     if hasattr(extensible_command, 'current_group'):
@@ -11,18 +119,21 @@ def extensible_command(f):
 
     extensions = []
     extensible_command.current_group = ep_group
-    for ep in pkg_resources.iter_entry_points(group=ep_group):
+    for ep in entry_points(ep_group):
         extensible_command.current_group = ep_group
         extension = ep.load()
         if hasattr(extension, '__click_params__'):
             f.__click_params__ += extension.__click_params__
-        extensions.append(extension)
+        extensions.append((ep.name, extension))
 
     del extensible_command.current_group
 
     def exec_extensions(*args, **kwargs):
-        for extension in extensions:
-            extension(*args, **kwargs)
+        results = []
+        for name, extension in extensions:
+            with trace.span('{}:{}'.format(ep_group, name), 'extension'):
+                results.append(extension(*args, **kwargs))
+        return results
 
     @wraps(f)
     def inner(*args, **kwargs):
@@ -32,7 +143,7 @@ def extensible_command(f):
 
 def extend_with(group):
     def inner(cls):
-        for ep in pkg_resources.iter_entry_points(group=group):
+        for ep in entry_points(group):
             cls.__bases__ += (ep.load(),)
 
         return cls
@@ -0,0 +1,297 @@
+import hashlib
+import json
+import os
+import re
+import shutil
+import requests
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from tempfile import NamedTemporaryFile, mkdtemp
+from .config import config
+from .lock import store_lock
+from . import metadata
+
+# Serves the local image store in the same layout as the image hub, so that
+# other hosts can use this one as their image_hub:
+#
+#   /images/<name>                       JSON list of versions
+#   /images/<name>/<version>/index.json  image index
+#   /blobs/<alg>/<digest>                blob, immutable
+#
+# With uploads enabled, blobs and indexes can be PUT at the same paths, which
+# is what `kostka image upload` does when image_upload_url is set.
+
+_COMPONENT = re.compile(r'^[A-Za-z0-9_][A-Za-z0-9._+-]*$')
+_MAX_INDEX_SIZE = 1024 * 1024
+
+
+class ImageStoreHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'  # Keep connections open between requests
+    server_version = 'kostka'
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            super().log_message(format, *args)
+
+    def do_HEAD(self):
+        self.handle_request(send_body=False)
+
+    def do_GET(self):
+        self.handle_request(send_body=True)
+
+    def parts(self):
+        parts = self.path.split('?', 1)[0].strip('/').split('/')
+        if not all(_COMPONENT.match(part) for part in parts):
+            return None
+        return parts
+
+    def do_PUT(self):
+        parts = self.parts()
+        if not self.server.accept_uploads:
+            self.close_connection = True  # The body is not read
+            return self.send_status(405)
+        if 'Content-Length' not in self.headers:
+            self.close_connection = True
+            return self.send_status(411)
+        if not self.headers['Content-Length'].isdigit():
+            self.close_connection = True
+            return self.send_status(400)
+        if parts is None:
+            self.discard_body()
+            return self.send_status(404)
+
+        # Bodies that are too big are refused before reading them
+        size = int(self.headers['Content-Length'])
+        if len(parts) == 3 and parts[0] == 'blobs':
+            if size > config['max_upload_size']:
+                self.close_connection = True
+                return self.send_status(413)
+            return self.receive_blob(parts[1], parts[2])
+        if len(parts) == 4 and parts[0] == 'images' and parts[3] == 'index.json':
+            if size > _MAX_INDEX_SIZE:
+                self.close_connection = True
+                return self.send_status(413)
+            return self.receive_index(parts[1], parts[2])
+        self.discard_body()
+        return self.send_status(404)
+
+    def discard_body(self):
+        remaining = int(self.headers['Content-Length'])
+        while remaining > 0:
+            chunk = self.rfile.read(min(remaining, 1024 * 1024))
+            if not chunk:
+                break
+            remaining -= len(chunk)
+
+    def receive_blob(self, alg, digest):
+        try:
+            sha = hashlib.new(alg)
+        except ValueError:
+            self.discard_body()
+            return self.send_status(400)
+
+        # Written like downloaded blobs: to a temporary file which is moved
+        # into place only if its digest matches
+        directory = os.path.join(config['blob_root'], alg)
+        os.makedirs(directory, exist_ok=True)
+        with store_lock(), NamedTemporaryFile(dir=config['blob_root'], delete=False) as f:
+            try:
+                size = remaining = int(self.headers['Content-Length'])
+                while remaining > 0:
+                    chunk = self.rfile.read(min(remaining, 1024 * 1024))
+                    if not chunk:
+                        break
+                    f.write(chunk)
+                    sha.update(chunk)
+                    remaining -= len(chunk)
+                f.close()
+                if remaining > 0 or sha.hexdigest() != digest:
+                    os.unlink(f.name)
+                    self.close_connection = remaining > 0
+                    return self.send_status(400)
+                os.chmod(f.name, 0o644)
+                os.rename(f.name, os.path.join(directory, digest))
+            except:
+                os.unlink(f.name)
+                raise
+            metadata.add_blob('{}:{}'.format(alg, digest), size)
+        return self.send_status(201)
+
+    def receive_index(self, name, version):
+        from .oci import Image, Blob
+        content = self.rfile.read(int(self.headers['Content-Length']))
+        try:
+            index = json.loads(content.decode('utf-8'))
+            manifest_blob = Blob(index['manifests'][0]['digest'])
+            with manifest_blob.path.open() as f:
+                manifest = json.loads(f.read())
+            blobs = [manifest_blob] + Image.manifest_layers(manifest)
+            if 'config' in manifest:
+                blobs.append(Blob(manifest['config']['digest']))
+        except (ValueError, KeyError, IndexError, OSError):
+            return self.send_status(409)  # Not an index, or its manifest wasn't uploaded first
+        # Indexes are uploaded last, an index referring to missing blobs is refused
+        if not all(blob.path.exists() for blob in blobs):
+            return self.send_status(409)
+
+        path = Image.root / name / version
+        with store_lock():
+            if path.exists():
+                with (path / 'index.json').open('rb') as f:
+                    return self.send_status(200 if f.read() == content else 409)
+
+            # Built next to its final place and renamed, so nobody sees a half-written image
+            path.parent.mkdir(parents=True, exist_ok=True)
+            tmp = mkdtemp(prefix='.upload-', dir=str(path.parent))
+            try:
+                for blob in blobs:
+                    link = os.path.join(tmp, 'blobs', blob.digest_alg, blob.digest)
+                    os.makedirs(os.path.dirname(link), exist_ok=True)
+                    if not os.path.lexists(link):
+                        os.symlink(str(blob.path), link)
+                with open(os.path.join(tmp, 'oci-layout'), 'w') as f:
+                    f.write(json.dumps(Image.layout(), sort_keys=True))
+                with open(os.path.join(tmp, 'index.json'), 'wb') as f:
+                    f.write(content)
+                os.chmod(tmp, 0o755)
+                os.rename(tmp, str(path))
+            except:
+                shutil.rmtree(tmp, ignore_errors=True)
+                raise
+            Image(name, version).load()  # Adds it to the metadata index
+        return self.send_status(201)
+
+    def handle_request(self, send_body):
+        parts = self.parts()
+        if parts is None:
+            return self.send_status(404)
+
+        if len(parts) == 3 and parts[0] == 'blobs':
+            path = os.path.join(config['blob_root'], parts[1], parts[2])
+            if not os.path.exists(path):
+                self.fetch_blob(parts[1], parts[2])
+            return self.send_file(path, '"{}"'.format(parts[2]), 'public, max-age=31536000, immutable',
+                                  send_body)
+        if len(parts) == 4 and parts[0] == 'images' and parts[3] == 'index.json':
+            # Versions like "latest" can change, so the ETag depends on the content
+            path = os.path.join(config['image_root'], parts[1], parts[2], 'index.json')
+            try:
+                with open(path, 'rb') as f:
+                    etag = '"{}"'.format(hashlib.sha256(f.read()).hexdigest())
+            except OSError:
+                return self.send_status(404)
+            return self.send_file(path, etag, 'no-cache', send_body, 'application/json')
+        if len(parts) == 2 and parts[0] == 'images':
+            return self.send_versions(os.path.join(config['image_root'], parts[1]), send_body)
+        return self.send_status(404)
+
+    def fetch_blob(self, alg, digest):
+        '''Downloads a layer blob of a local image that wasn't kept after
+           the layer was extracted (keep_layer_blobs)'''
+        from .oci import Blob, DownloadError
+        from . import hub
+        name = '{}:{}'.format(alg, digest)
+        if not config['image_hub'] or name not in metadata.used_blobs():
+            return
+        try:
+            with store_lock():
+                Blob(name).download(progressbar=False)
+        except (DownloadError, hub.Offline, requests.RequestException, OSError) as e:
+            self.log_error('Cannot download %s: %s', name, e)
+
+    def send_status(self, code, headers=()):
+        self.send_response(code)
+        for name, value in headers:
+            self.send_header(name, value)
+        if code != 304:  # A 304 response has no body, its Content-Length would be the one of the document
+            self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def send_versions(self, path, send_body):
+        try:
+            versions = sorted(entry.name for entry in os.scandir(path)
+                              if entry.is_dir() and not entry.name.startswith('.'))
+        except OSError:
+            return self.send_status(404)
+        body = json.dumps([{'name': version, 'type': 'directory'} for version in versions]).encode('utf-8')
+        etag = '"{}"'.format(hashlib.sha256(body).hexdigest())
+        if etag in (tag.strip() for tag in self.headers.get('If-None-Match', '').split(',')):
+            return self.send_status(304, [('ETag', etag), ('Cache-Control', 'no-cache')])
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('ETag', etag)
+        self.send_header('Cache-Control', 'no-cache')
+        self.end_headers()
+        if send_body:
+            self.wfile.write(body)
+
+    def send_file(self, path, etag, cache_control, send_body, content_type='application/octet-stream'):
+        try:
+            f = open(path, 'rb')
+        except OSError:
+            return self.send_status(404)
+
+        with f:
+            size = os.fstat(f.fileno()).st_size
+            if etag in (tag.strip() for tag in self.headers.get('If-None-Match', '').split(',')):
+                return self.send_status(304, [('ETag', etag), ('Cache-Control', cache_control)])
+
+            start, end = 0, size
+            byte_range = None
+            ranged = self.headers.get('Range')
+            if ranged is not None and self.headers.get('If-Range', etag) == etag:
+                try:
+                    byte_range = parse_range(ranged, size)
+                except ValueError:
+                    return self.send_status(416, [('Content-Range', 'bytes */{}'.format(size))])
+            if byte_range is not None:
+                start, end = byte_range
+                self.send_response(206)
+                self.send_header('Content-Range', 'bytes {}-{}/{}'.format(start, end - 1, size))
+            else:
+                self.send_response(200)
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(end - start))
+            self.send_header('Accept-Ranges', 'bytes')
+            self.send_header('ETag', etag)
+            self.send_header('Cache-Control', cache_control)
+            self.end_headers()
+            if send_body and end > start:
+                # Uses sendfile(2), so the data never passes through python
+                self.connection.sendfile(f, start, end - start)
+
+
+def parse_range(header, size):
+    '''Parses a single-range Range header into (start, end), end being
+       exclusive. Returns None for headers that are ignored (malformed, or
+       asking for several ranges), and raises ValueError if the range can't
+       be satisfied.'''
+    match = re.match(r'^bytes=(\d*)-(\d*)$', header.strip())
+    if match is None or match.groups() == ('', ''):
+        return None
+    first, last = match.groups()
+    if first == '':
+        start, end = max(size - int(last), 0), size  # The last N bytes
+    else:
+        start = int(first)
+        if last != '' and int(last) < start:
+            return None  # Invalid, so it's ignored
+        end = min(int(last) + 1, size) if last != '' else size
+    if start >= end:
+        raise ValueError('Unsatisfiable range: {}'.format(header))
+    return start, end
+
+
+def serve(host, port, verbose=False, accept_uploads=False):
+    server = ThreadingHTTPServer((host, port), ImageStoreHandler)
+    server.daemon_threads = True
+    server.verbose = verbose
+    server.accept_uploads = accept_uploads
+    print('Serving {} and {} on http://{}:{}/'.format(config['image_root'], config['blob_root'],
+                                                      host or '0.0.0.0', server.server_address[1]))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
@@ -0,0 +1,98 @@
+import glob
+import hashlib
+import json
+import os
+import re
+import shutil
+import subprocess
+from pathlib import Path
+from tempfile import mkdtemp
+from .config import config
+from .tar import write_tar, restore_whiteouts
+from . import layer_cache
+
+# Overlayfs can't stack more than 500 lowerdirs, all of them have to fit in a
+# single page of mount options, and every lookup walks the whole stack. Deep
+# chains are mounted with their bottom lowerdirs squashed into one directory.
+root = Path(config['squash_root'])
+
+# Fingerprints of lowerdirs that are not image layers, computed at most once
+# per process: rendering the units of many containers that share a parent
+# walks the parent's tree only once.
+_fingerprints = {}
+
+
+def split(lowerdirs, max_depth):
+    '''Splits lowerdirs (in mount order) into the ones that are mounted as
+       they are and the ones that have to be squashed'''
+    if not max_depth or len(lowerdirs) <= max_depth:
+        return list(lowerdirs), []
+    return list(lowerdirs[:max_depth - 1]), list(lowerdirs[max_depth - 1:])
+
+
+def path(lowerdirs):
+    '''Where the squashed lowerdirs are cached. Extracted image layers never
+       change, other directories are identified by the metadata of their files.'''
+    key = []
+    for lowerdir in lowerdirs:
+        if Path(lowerdir).parent.parent == Path(config['layer_root']):
+            key.append([str(lowerdir)])
+        else:
+            if str(lowerdir) not in _fingerprints:
+                _fingerprints[str(lowerdir)] = layer_cache.fingerprint([lowerdir])
+            key.append([str(lowerdir), _fingerprints[str(lowerdir)]])
+    return root / hashlib.sha256(json.dumps(key).encode('utf-8', 'surrogateescape')).hexdigest()
+
+
+def squash(lowerdirs):
+    '''Merges lowerdirs (in mount order) into a single directory, keeping the
+       whiteouts, and returns its path'''
+    dest = path(lowerdirs)
+    if dest.exists():
+        return dest
+
+    root.mkdir(parents=True, exist_ok=True)
+    tmp = mkdtemp(dir=str(root))
+    try:
+        tar = subprocess.Popen(['tar', '-x', '--numeric-owner', '-p', '--xattrs', '--xattrs-include=*',
+                                '--directory={}'.format(tmp), '-f', '-'], stdin=subprocess.PIPE)
+        try:
+            write_tar(tar.stdin, *reversed(lowerdirs))
+        finally:
+            tar.stdin.close()
+            if tar.wait() != 0:
+                raise subprocess.CalledProcessError(tar.returncode, tar.args)
+        restore_whiteouts(tmp)
+        try:
+            os.rename(tmp, str(dest))
+        except OSError:
+            if not dest.exists():
+                raise
+            shutil.rmtree(tmp)  # Squashed by somebody else in the meantime
+    except:
+        shutil.rmtree(tmp, ignore_errors=True)
+        raise
+    return dest
+
+
+def flatten(lowerdirs, max_depth):
+    '''Returns at most max_depth lowerdirs with the same contents'''
+    keep, squashed = split(lowerdirs, max_depth)
+    if len(squashed) == 0:
+        return keep
+    return keep + [str(squash(squashed))]
+
+
+def referenced():
+    '''Names of the squashed directories that mount units or current mounts
+       use. A squash stays mounted after the lowerdirs it was made of change,
+       until the container is restarted with its new unit.'''
+    pattern = re.compile(re.escape(str(root)) + r'/([0-9a-f]{64})')
+    names = set()
+    for path in glob.glob(os.path.join(config['unit_dir'], '*.mount')) + ['/proc/self/mounts']:
+        try:
+            with open(path, errors='surrogateescape') as f:
+                names.update(pattern.findall(f.read()))
+        except OSError:
+            pass
+    return names
@@ -0,0 +1,288 @@
+import os
+import string
+import subprocess
+import threading
+import time
+from tempfile import NamedTemporaryFile
+from .config import config
+
+UNIT_TYPES = ('service', 'socket', 'target', 'device', 'mount', 'automount',
+              'swap', 'timer', 'path', 'slice', 'scope')
+
+_VALID_CHARS = set(string.ascii_letters + string.digits + ':_.')
+
+
+class SystemdError(Exception):
+    pass
+
+
+def escape_path(path):
+    '''Same as `systemd-escape -p PATH`'''
+    parts = []
+    for part in str(path).split('/'):
+        if part in ('', '.'):
+            continue
+        if part == '..':
+            raise ValueError('Path is not normalized: {}'.format(path))
+        parts.append(part)
+    if len(parts) == 0:
+        return '-'
+
+    result = []
+    for i, char in enumerate('/'.join(parts).encode('utf-8', 'surrogateescape')):
+        if char == ord('/'):
+            result.append('-')
+        elif chr(char) in _VALID_CHARS and not (i == 0 and char == ord('.')):
+            # A leading dot would create a hidden unit
+            result.append(chr(char))
+        else:
+            result.append('\\x{:02x}'.format(char))
+    return ''.join(result)
+
+
+def unit_name(name):
+    '''Appends .service to names without a unit type, like systemctl does'''
+    if '.' in name and name.rsplit('.', 1)[1] in UNIT_TYPES:
+        return name
+    return name + '.service'
+
+
+class UnitWriter:
+    '''Writes unit files only when their content changes, and counts how many did'''
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.changed = 0
+        self.unchanged = 0
+
+    def write(self, path, content):
+        try:
+            with open(path) as f:
+                changed = f.read() != content
+        except FileNotFoundError:
+            changed = True
+
+        if changed:
+            with NamedTemporaryFile('w', dir=os.path.dirname(path), delete=False) as f:
+                f.write(content)
+            os.chmod(f.name, 0o644)
+            os.rename(f.name, path)
+
+        with self.lock:
+            if changed:
+                self.changed += 1
+            else:
+                self.unchanged += 1
+        return changed
+
+    def mark_changed(self):
+        '''Counts a unit that was written some other way'''
+        with self.lock:
+            self.changed += 1
+
+
+units = UnitWriter()
+
+
+def write_unit(path, content):
+    return units.write(path, content)
+
+
+class SubprocessBackend:
+    '''Talks to systemd by running systemctl and machinectl'''
+    def is_active(self, unit):
+        return subprocess.call([config['systemctl'], 'is-active', unit_name(unit)],
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL) == 0
+
+    def start(self, unit):
+        subprocess.check_call([config['systemctl'], 'start', unit_name(unit)])
+
+    def stop(self, unit):
+        subprocess.check_call([config['systemctl'], 'stop', unit_name(unit)])
+
+    def kill(self, unit):
+        subprocess.check_call([config['systemctl'], 'kill', unit_name(unit)])
+
+    def reload(self):
+        subprocess.check_call([config['systemctl'], 'daemon-reload'])
+
+    def leader_pid(self, machine):
+        data = subprocess.check_output([config['machinectl'], 'show', '--property=Leader', machine]) \
+                         .decode('utf-8').strip().split('\n')
+        data = dict(line.split('=', 1) for line in data)
+        return int(data['Leader'])
+
+    def unit_properties(self, units, properties):
+        '''Returns {unit: {property: value}} using a single `systemctl show` call'''
+        if len(units) == 0:
+            return {}
+        cmd = [config['systemctl'], 'show', '--property={}'.format(','.join(['Id'] + list(properties))), '--']
+        cmd += [unit_name(unit) for unit in units]
+        try:
+            output = subprocess.check_output(cmd).decode('utf-8')
+        except subprocess.CalledProcessError as e:
+            output = e.output.decode('utf-8')
+
+        # systemctl skips units it can't show, so the blocks are matched by their Id
+        names = {unit_name(unit): unit for unit in units}
+        result = {}
+        for block in output.strip('\n').split('\n\n'):
+            values = dict(line.split('=', 1) for line in block.split('\n') if '=' in line)
+            if values.get('Id') in names:
+                result[names[values['Id']]] = {prop: values[prop] for prop in properties if prop in values}
+        return result
+
+
+class DBusBackend:
+    '''Talks to systemd and machined over the system D-Bus, without forking'''
+    SYSTEMD = 'org.freedesktop.systemd1'
+    MACHINED = 'org.freedesktop.machine1'
+
+    def __init__(self):
+        from jeepney import DBusAddress
+        from jeepney.io.blocking import open_dbus_connection
+        self.connection = open_dbus_connection(bus='SYSTEM')
+        self.lock = threading.Lock()
+        self.manager = DBusAddress('/org/freedesktop/systemd1', bus_name=self.SYSTEMD,
+                                   interface='org.freedesktop.systemd1.Manager')
+        self.machines = DBusAddress('/org/freedesktop/machine1', bus_name=self.MACHINED,
+                                    interface='org.freedesktop.machine1.Manager')
+        self.subscribed = False
+
+    def send(self, message):
+        from jeepney import DBusErrorResponse
+        from jeepney.wrappers import unwrap_msg
+        with self.lock:
+            reply = self.connection.send_and_get_reply(message, timeout=config['systemd_timeout'])
+        try:
+            return unwrap_msg(reply)
+        except DBusErrorResponse as e:
+            raise SystemdError('{}: {}'.format(e.name, ' '.join(map(str, e.data))))
+
+    def call(self, address, method, signature=None, body=()):
+        from jeepney import new_method_call
+        return self.send(new_method_call(address, method, signature, body))
+
+    def get_all(self, path, bus_name, interface):
+        from jeepney import DBusAddress, Properties
+        address = DBusAddress(path, bus_name=bus_name, interface=interface)
+        properties = self.send(Properties(address).get_all())[0]
+        return {name: value for name, (signature, value) in properties.items()}
+
+    def unit_path(self, unit):
+        return self.call(self.manager, 'LoadUnit', 's', (unit_name(unit),))[0]
+
+    def active_state(self, unit):
+        return self.get_all(self.unit_path(unit), self.SYSTEMD, 'org.freedesktop.systemd1.Unit')['ActiveState']
+
+    def is_active(self, unit):
+        return self.active_state(unit) == 'active'
+
+    def run_job(self, method, *args):
+        '''Starts a job and waits for it to finish, like systemctl does'''
+        from jeepney import MatchRule, message_bus
+        rule = MatchRule(type='signal', sender=self.SYSTEMD, interface=self.manager.interface,
+                         member='JobRemoved', path=self.manager.object_path)
+        if not self.subscribed:
+            self.call(self.manager, 'Subscribe')
+            self.send(message_bus.AddMatch(rule))
+            self.subscribed = True
+
+        # Signals for every job end up in the queue of every thread waiting for one
+        with self.connection.filter(rule, bufsize=None) as queue:
+            job = self.call(self.manager, method, 's' * len(args), args)[0]
+            deadline = time.monotonic() + config['systemd_timeout']
+            while True:
+                # The connection is only locked for a moment at a time, so that
+                # other threads can use it while this one waits for its job
+                with self.lock:
+                    try:
+                        signal = self.connection.recv_until_filtered(queue, timeout=0.1)
+                    except TimeoutError:
+                        signal = None
+                if signal is None:
+                    if time.monotonic() > deadline:
+                        raise SystemdError('Timed out waiting for job {} for {}'.format(method, args[0]))
+                    continue
+                job_id, job_path, unit, result = signal.body
+                if job_path == job:
+                    break
+        if result != 'done':
+            raise SystemdError('Job {} for {} failed: {}'.format(method, args[0], result))
+
+    def start(self, unit):
+        self.run_job('StartUnit', unit_name(unit), 'replace')
+
+    def stop(self, unit):
+        self.run_job('StopUnit', unit_name(unit), 'replace')
+
+    def kill(self, unit):
+        self.call(self.manager, 'KillUnit', 'ssi', (unit_name(unit), 'all', 15))
+
+    def reload(self):
+        self.call(self.manager, 'Reload')
+
+    def leader_pid(self, machine):
+        path = self.call(self.machines, 'GetMachine', 's', (machine,))[0]
+        return self.get_all(path, self.MACHINED, 'org.freedesktop.machine1.Machine')['Leader']
+
+    def get(self, path, bus_name, interface, name):
+        from jeepney import DBusAddress, Properties
+        address = DBusAddress(path, bus_name=bus_name, interface=interface)
+        return self.send(Properties(address).get(name))[0][1]
+
+    # Returned by ListUnitsByNames, other properties have to be read one by one
+    LISTED_PROPERTIES = ('Id', 'Description', 'LoadState', 'ActiveState', 'SubState')
+
+    @staticmethod
+    def property_interface(unit, name):
+        '''Timestamps and states are properties of all units, the others
+           belong to the unit type, e.g. MainPID to org.freedesktop.systemd1.Service'''
+        if name.endswith(('Timestamp', 'TimestampMonotonic')) or name in DBusBackend.LISTED_PROPERTIES:
+            return 'org.freedesktop.systemd1.Unit'
+        return 'org.freedesktop.systemd1.' + unit.rsplit('.', 1)[-1].capitalize()
+
+    def unit_properties(self, units, properties):
+        '''Returns {unit: {property: value}}, with the states of all units
+           from a single ListUnitsByNames call'''
+        if len(units) == 0:
+            return {}
+        names = {unit_name(unit): unit for unit in units}
+        listed = self.call(self.manager, 'ListUnitsByNames', 'as', (list(names),))[0]
+        extra = [prop for prop in properties if prop not in self.LISTED_PROPERTIES]
+        result = {}
+        for name, description, load_state, active_state, sub_state, following, path, *job in listed:
+            if name not in names:
+                continue
+            listed_values = dict(zip(self.LISTED_PROPERTIES, (name, description, load_state, active_state, sub_state)))
+            values = result[names[name]] = {prop: listed_values[prop] for prop in properties
+                                            if prop in listed_values}
+            if load_state == 'not-found':
+                continue
+            for prop in extra:
+                try:
+                    values[prop] = str(self.get(path, self.SYSTEMD, self.property_interface(name, prop), prop))
+                except SystemdError:
+                    pass  # Not a property of this unit
+        return result
+
+
+_backend = None
+_backend_lock = threading.Lock()
+
+
+def backend():
+    '''Returns the systemd backend configured with `systemd_backend`: dbus,
+       subprocess, or auto (D-Bus if jeepney is installed and the bus is reachable)'''
+    global _backend
+    with _backend_lock:
+        if _backend is None:
+            if config['systemd_backend'] == 'subprocess':
+                _backend = SubprocessBackend()
+            elif config['systemd_backend'] == 'dbus':
+                _backend = DBusBackend()
+            else:
+                try:
+                    _backend = DBusBackend()
+                except Exception:
+                    _backend = SubprocessBackend()
+        return _backend
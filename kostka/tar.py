@@ -0,0 +1,168 @@
+import os
+import stat
+import tarfile
+
+# Same timestamp as `tar --mtime=2000-01-01 00:00Z`, used to make layers reproducible
+MTIME = 946684800
+
+WHITEOUT_PREFIX = '.wh.'
+OPAQUE_WHITEOUT = '.wh..wh..opq'
+OPAQUE_XATTR = 'trusted.overlay.opaque'
+
+
+def is_whiteout(st):
+    '''Overlayfs marks deleted files with a 0/0 character device'''
+    return stat.S_ISCHR(st.st_mode) and st.st_rdev == 0
+
+
+def is_opaque(path):
+    try:
+        return os.getxattr(path, OPAQUE_XATTR, follow_symlinks=False) == b'y'
+    except OSError:
+        return False
+
+
+def xattrs(path):
+    try:
+        names = os.listxattr(path, follow_symlinks=False)
+    except OSError:
+        return {}
+
+    result = {}
+    for name in sorted(names):
+        if name.startswith('trusted.overlay.'):
+            continue  # Overlayfs internals, converted to whiteouts instead
+        try:
+            value = os.getxattr(path, name, follow_symlinks=False)
+        except OSError:
+            continue
+        result['SCHILY.xattr.' + name] = value.decode('utf-8', 'surrogateescape')
+    return result
+
+
+def write_tar(fileobj, *directories):
+    '''Writes a deterministic tar stream of the given directories into fileobj,
+       in the same way as `rsync`-ing them on top of each other would.
+
+       Overlayfs whiteouts and opaque directories are converted to
+       their OCI counterparts (`.wh.` files).
+    '''
+    hardlinks = {}
+    # The directories themselves may be symlinks, like a container's overlay.fs
+    directories = [os.path.realpath(str(d)) for d in directories]
+    with tarfile.open(fileobj=fileobj, mode='w|', format=tarfile.PAX_FORMAT) as tar:
+        root = os.lstat(directories[-1])
+        _add(tar, '.', directories[-1], root, hardlinks)
+        _write_dir(tar, '.', directories, hardlinks)
+
+
+def _write_dir(tar, name, sources, hardlinks):
+    entries = {}
+    for source in sources:
+        with os.scandir(source) as it:
+            for entry in it:
+                entries[entry.name] = entry
+
+    for entry_name in sorted(entries):
+        entry = entries[entry_name]
+        entry_path = name + '/' + entry_name
+        st = entry.stat(follow_symlinks=False)
+
+        if is_whiteout(st):
+            _add_empty(tar, name + '/' + WHITEOUT_PREFIX + entry_name, st)
+            continue
+
+        _add(tar, entry_path, entry.path, st, hardlinks)
+        if not stat.S_ISDIR(st.st_mode):
+            continue
+
+        # Find the directories that make up this entry. A file or a whiteout
+        # replaces the directories below it in the sources, an opaque
+        # directory also hides the layers below the sources.
+        children = []
+        opaque = False
+        for source in sources:
+            path = os.path.join(source, entry_name)
+            try:
+                child_st = os.lstat(path)
+            except FileNotFoundError:
+                continue
+            if not stat.S_ISDIR(child_st.st_mode):
+                children = []
+            elif is_opaque(path):
+                children = [path]
+                opaque = True
+            else:
+                children.append(path)
+
+        if opaque:
+            _add_empty(tar, entry_path + '/' + OPAQUE_WHITEOUT, st)
+        _write_dir(tar, entry_path, children, hardlinks)
+
+
+def _tarinfo(name, st):
+    info = tarfile.TarInfo(name)
+    info.mode = stat.S_IMODE(st.st_mode)
+    info.uid = st.st_uid
+    info.gid = st.st_gid
+    info.uname = ''
+    info.gname = ''
+    info.mtime = MTIME
+    return info
+
+
+def _add_empty(tar, name, st):
+    info = _tarinfo(name, st)
+    info.type = tarfile.REGTYPE
+    info.size = 0
+    tar.addfile(info)
+
+
+def _add(tar, name, path, st, hardlinks):
+    info = _tarinfo(name, st)
+    info.pax_headers = xattrs(path)
+    mode = st.st_mode
+
+    if stat.S_ISREG(mode):
+        if st.st_nlink > 1:
+            key = (st.st_dev, st.st_ino)
+            if key in hardlinks:
+                info.type = tarfile.LNKTYPE
+                info.linkname = hardlinks[key]
+                tar.addfile(info)
+                return
+            hardlinks[key] = name
+        info.type = tarfile.REGTYPE
+        info.size = st.st_size
+        with open(path, 'rb') as f:
+            tar.addfile(info, f)
+        return
+
+    if stat.S_ISDIR(mode):
+        info.type = tarfile.DIRTYPE
+    elif stat.S_ISLNK(mode):
+        info.type = tarfile.SYMTYPE
+        info.linkname = os.readlink(path)
+    elif stat.S_ISCHR(mode) or stat.S_ISBLK(mode):
+        info.type = tarfile.CHRTYPE if stat.S_ISCHR(mode) else tarfile.BLKTYPE
+        info.devmajor = os.major(st.st_rdev)
+        info.devminor = os.minor(st.st_rdev)
+    elif stat.S_ISFIFO(mode):
+        info.type = tarfile.FIFOTYPE
+    else:
+        return  # Sockets can't be archived
+    tar.addfile(info)
+
+
+def restore_whiteouts(path):
+    '''Converts OCI whiteouts in an extracted layer back to overlayfs ones,
+       so that the layer can be used as a lowerdir.'''
+    for dirpath, dirnames, filenames in os.walk(str(path)):
+        for filename in filenames:
+            if not filename.startswith(WHITEOUT_PREFIX):
+                continue
+            os.unlink(os.path.join(dirpath, filename))
+            if filename == OPAQUE_WHITEOUT:
+                os.setxattr(dirpath, OPAQUE_XATTR, b'y')
+            else:
+                os.mknod(os.path.join(dirpath, filename[len(WHITEOUT_PREFIX):]), stat.S_IFCHR, os.makedev(0, 0))
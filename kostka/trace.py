@@ -0,0 +1,119 @@
+import atexit
+import json
+import os
+import subprocess
+import sys
+import threading
+import time
+from contextlib import contextmanager
+
+# Timed spans of a command, written as Chrome trace events (chrome://tracing,
+# https://ui.perfetto.dev) when kostka exits. When tracing is off, span()
+# costs a single check.
+
+_events = None
+_path = None
+_command = None
+
+
+def _now():
+    return time.perf_counter_ns() // 1000
+
+
+@contextmanager
+def _span(name, category, args):
+    start = _now()
+    try:
+        yield args
+    finally:
+        _events.append({
+            'name': name, 'cat': category, 'ph': 'X', 'ts': start, 'dur': _now() - start,
+            'pid': os.getpid(), 'tid': threading.get_ident(), 'args': args,
+        })
+
+
+@contextmanager
+def _nothing():
+    yield {}
+
+
+def span(name, category, **args):
+    '''Times the block. Values added to the yielded dict (bytes transferred,
+       exit codes...) are stored with the span.'''
+    if _events is None:
+        return _nothing()
+    return _span(name, category, args)
+
+
+class TracedPopen(subprocess.Popen):
+    '''Records every command kostka runs, from its start until it's waited for'''
+    def __init__(self, args, *popenargs, **kwargs):
+        self._trace_start = _now()
+        self._trace_args = args
+        super().__init__(args, *popenargs, **kwargs)
+
+    def _trace_finish(self):
+        if self.returncode is None or self._trace_start is None:
+            return
+        args = self._trace_args
+        argv = [args] if isinstance(args, (str, bytes, os.PathLike)) else list(args)
+        name = ' '.join(str(arg) for arg in argv[:2])
+        _events.append({
+            'name': name, 'cat': 'subprocess', 'ph': 'X', 'ts': self._trace_start,
+            'dur': _now() - self._trace_start, 'pid': os.getpid(), 'tid': threading.get_ident(),
+            'args': {'cmdline': ' '.join(str(arg) for arg in argv), 'returncode': self.returncode},
+        })
+        self._trace_start = None
+
+    def wait(self, *args, **kwargs):
+        try:
+            return super().wait(*args, **kwargs)
+        finally:
+            self._trace_finish()
+
+    def poll(self):
+        try:
+            return super().poll()
+        finally:
+            self._trace_finish()
+
+
+def start(path, command):
+    '''Starts recording spans, which are written to path when kostka exits'''
+    global _events, _path, _command
+    if _events is not None:
+        return
+    _events = []
+    _path = path
+    _command = (command, _now())
+    subprocess.Popen = TracedPopen
+    # Commands run by kostka (hooks calling kostka, for example) would overwrite the file
+    os.environ.pop('KOSTKA_TRACE', None)
+    atexit.register(finish)
+
+
+def summary(events):
+    '''Returns (category, name, count, total seconds) sorted by the total time'''
+    totals = {}
+    for event in events:
+        key = (event['cat'], event['name'])
+        count, total = totals.get(key, (0, 0))
+        totals[key] = (count + 1, total + event['dur'])
+    return sorted(((cat, name, count, total / 1e6) for (cat, name), (count, total) in totals.items()),
+                  key=lambda row: -row[3])
+
+
+def finish():
+    name, start = _command
+    _events.append({
+        'name': name, 'cat': 'command', 'ph': 'X', 'ts': start, 'dur': _now() - start,
+        'pid': os.getpid(), 'tid': threading.get_ident(), 'args': {},
+    })
+    with open(_path, 'w') as f:
+        f.write(json.dumps({'traceEvents': _events, 'displayTimeUnit': 'ms'}))
+
+    print('{:<12} {:<50} {:>6} {:>10}'.format('CATEGORY', 'NAME', 'COUNT', 'SECONDS'), file=sys.stderr)
+    for category, name, count, total in summary(_events):
+        if len(name) > 50:
+            name = name[:47] + '...'
+        print('{:<12} {:<50} {:>6} {:>10.3f}'.format(category, name, count, total), file=sys.stderr)
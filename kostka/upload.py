@@ -0,0 +1,167 @@
+import base64
+import hashlib
+import subprocess
+import time
+import requests
+from concurrent.futures import ThreadPoolExecutor
+from . import hub
+from .config import config
+from .lock import store_lock
+from .oci import Image, Blob
+
+# Blobs are content-addressed, so an upload only sends the blobs the
+# destination doesn't have yet, and publishes index.json once all of them
+# have arrived. Until then, nobody can see the new image.
+
+
+class UploadError(Exception):
+    pass
+
+
+class RsyncDestination:
+    '''Uploads with rsync (over ssh) to images/ and blobs/ in the home
+       directory of image_upload_host'''
+    def __init__(self, host, ssh_command=None):
+        self.host = host
+        self.command = ['rsync']
+        if ssh_command:
+            self.command += ['--rsh={}'.format(ssh_command)]
+
+    def __str__(self):
+        return self.host
+
+    def _sizes(self, alg):
+        '''Returns {digest: size} of the blobs the destination has'''
+        result = subprocess.run(self.command + ['--list-only', '{}:blobs/{}/'.format(self.host, alg)],
+                                stdout=subprocess.PIPE, universal_newlines=True)
+        if result.returncode == 23:
+            return {}  # The directory doesn't exist yet
+        if result.returncode != 0:
+            raise UploadError('Cannot list blobs on {}: rsync exited with {}'.format(self.host, result.returncode))
+        sizes = {}
+        for line in result.stdout.splitlines():
+            fields = line.split(None, 4)
+            if len(fields) == 5 and fields[0].startswith('-'):
+                sizes[fields[4]] = int(fields[1].replace(',', '').replace('.', ''))
+        return sizes
+
+    def missing(self, blobs):
+        sizes = {}
+        for alg in set(blob.digest_alg for blob in blobs):
+            sizes[alg] = self._sizes(alg)
+        return [blob for blob in blobs if sizes[blob.digest_alg].get(blob.digest) != len(blob)]
+
+    def put_blob(self, blob):
+        # rsync checks the whole file after the transfer and moves it into
+        # place only then, --partial-dir keeps interrupted transfers out of sight.
+        # It's relative to blobs/<alg>/, so it's in the home directory, outside the blob tree.
+        subprocess.check_call(self.command + [
+            '-aR', '--chmod=755', '--partial-dir=../../.rsync-partial',
+            '{}/{}'.format(blob.digest_alg, blob.digest), '{}:blobs/'.format(self.host)
+        ], cwd=str(Blob.root))
+
+    def put_index(self, image):
+        subprocess.check_call(self.command + [
+            '-aR', '--chmod=755', '{}/{}/index.json'.format(image.name, image.path.name),
+            '{}:images/'.format(self.host)
+        ], cwd=str(Image.root))
+
+
+class HttpDestination:
+    '''Uploads with HTTP PUT to the hub layout under url'''
+    def __init__(self, url):
+        self.url = url.rstrip('/')
+
+    def __str__(self):
+        return self.url
+
+    def blob_url(self, blob):
+        return '{}/blobs/{}/{}'.format(self.url, blob.digest_alg, blob.digest)
+
+    def _has(self, blob):
+        with hub.head(self.blob_url(blob)) as response:
+            if response.status_code == 404:
+                return False
+            if response.status_code != 200:
+                raise UploadError('Cannot check {}. Status code: {}'.format(self.blob_url(blob),
+                                                                            response.status_code))
+            return int(response.headers.get('content-length', -1)) == len(blob)
+
+    def missing(self, blobs):
+        with ThreadPoolExecutor(max_workers=config['upload_workers']) as executor:
+            return [blob for blob, has in zip(blobs, executor.map(self._has, blobs)) if not has]
+
+    def put(self, url, path, sha256):
+        # Lets the destination check the file before storing it (RFC 3230)
+        headers = {'Digest': 'SHA-256=' + base64.b64encode(sha256).decode('ascii')}
+        attempt = 0
+        while True:
+            try:
+                # Opened again for every attempt, so that each one sends the whole file
+                with open(str(path), 'rb') as f, hub.put(url, data=f, headers=headers) as response:
+                    if response.status_code in (200, 201, 204):
+                        return
+                    error = 'Status code: {}'.format(response.status_code)
+                    if response.status_code < 500:
+                        raise UploadError('Failed to upload {}. {}'.format(url, error))
+            except requests.RequestException as e:
+                error = e
+            attempt += 1
+            if attempt > config['hub_retries']:
+                raise UploadError('Failed to upload {}. {}'.format(url, error))
+            time.sleep(config['hub_backoff_factor'] * 2 ** attempt)
+
+    def put_blob(self, blob):
+        if blob.digest_alg == 'sha256':
+            sha256 = bytes.fromhex(blob.digest)
+        else:
+            with blob.path.open('rb') as f:
+                sha256 = hashlib.sha256(f.read()).digest()
+        self.put(self.blob_url(blob), blob.path, sha256)
+
+    def put_index(self, image):
+        path = image.path / 'index.json'
+        with path.open('rb') as f:
+            sha256 = hashlib.sha256(f.read()).digest()
+        self.put('{}/images/{}/{}/index.json'.format(self.url, image.name, image.path.name), path, sha256)
+
+
+def destination():
+    if config['image_upload_url']:
+        return HttpDestination(config['image_upload_url'])
+    if config['image_upload_host']:
+        return RsyncDestination(config['image_upload_host'], config['image_upload_ssh_command'])
+    raise UploadError('Image upload not configured. Cannot upload image.')
+
+
+def image_blobs(image):
+    '''All blobs of the image: its manifest, config and layers'''
+    return [Blob(alg.name, link.name)
+            for alg in sorted((image.path / 'blobs').iterdir())
+            for link in sorted(alg.iterdir())]
+
+
+def upload(image, dest, progress=print):
+    '''Uploads the blobs dest doesn't have, then the index. Returns the
+       uploaded blobs.'''
+    blobs = image_blobs(image)
+    with store_lock():
+        for blob in blobs:
+            # Layer blobs that weren't kept after extraction (keep_layer_blobs)
+            blob.download(progressbar=False)
+    missing = dest.missing(blobs)
+    progress('{} of {} blobs are already on {}'.format(len(blobs) - len(missing), len(blobs), dest))
+
+    def put(blob):
+        dest.put_blob(blob)
+        progress('Uploaded {} ({} bytes)'.format(blob.name, len(blob)))
+
+    with ThreadPoolExecutor(max_workers=config['upload_workers']) as executor:
+        list(executor.map(put, missing))
+
+    broken = dest.missing(missing)
+    if len(broken) > 0:
+        raise UploadError('Blobs did not arrive intact on {}: {}'.format(
+            dest, ', '.join(blob.name for blob in broken)))
+    dest.put_index(image)
+    return missing
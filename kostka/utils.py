@@ -1,25 +1,79 @@
 import subprocess
 import os
+import signal
 import sys
+import time
+import threading
+import importlib
 import click
-import pkg_resources
+from concurrent.futures import ThreadPoolExecutor
+from .config import config
 from .container import Container
+from .plugins import entry_points
+from . import trace
+from . import systemd
 
 
-@click.group()
-def cli():
-    pass
+# kostka.py changes to the package directory, paths given on the command
+# line are relative to the directory kostka was started in
+invocation_cwd = os.getcwd()
+
+
+class InvocationPath(click.Path):
+    '''click.Path for paths relative to the directory kostka was started in'''
+    def convert(self, value, param, ctx):
+        return super().convert(os.path.join(invocation_cwd, value), param, ctx)
+
+
+class LazyGroup(click.Group):
+    '''Imports command modules only when their command is used. Plugins
+       from the `kostka` entry point group are loaded before any command
+       runs, because they can add subcommands to the built-in groups.'''
+    def __init__(self, *args, lazy_commands=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.lazy_commands = lazy_commands or {}
+        self.plugins_loaded = False
+
+    def load_plugins(self):
+        if not self.plugins_loaded:
+            self.plugins_loaded = True
+            for ep in entry_points('kostka'):
+                ep.load()
+
+    def list_commands(self, ctx):
+        self.load_plugins()
+        return sorted(set(self.lazy_commands) | set(super().list_commands(ctx)))
+
+    def get_command(self, ctx, name):
+        if name not in self.commands and name in self.lazy_commands:
+            importlib.import_module(self.lazy_commands[name], __package__)
+        self.load_plugins()
+        return super().get_command(ctx, name)
+
+
+def _commands():
+    from .commands import COMMANDS
+    return {name: '.commands.' + module for name, module in COMMANDS.items()}
+
+
+@click.group(cls=LazyGroup, lazy_commands=_commands())
+@click.option("--offline", is_flag=True, help="Don't contact the image hub, use only images that are already downloaded.")
+@click.option("--trace", "trace_path", type=InvocationPath(dir_okay=False), envvar='KOSTKA_TRACE',
+              help="Write a Chrome trace of where the command spends its time to this file, "
+                   "and print a summary. Can also be set with KOSTKA_TRACE.")
+def cli(offline, trace_path):
+    if offline:
+        config['offline'] = True
+    if trace_path:
+        trace.start(trace_path, ' '.join(['kostka'] + sys.argv[1:]))
 
 
 def get_pid(name):
-    data = subprocess.check_output(['/bin/machinectl', 'show', name]) \
-                     .decode("utf-8").strip().split("\n")
-    data = dict(line.split("=", 1) for line in data)
-    return data['Leader']
+    return str(systemd.backend().leader_pid(name))
 
 
 def systemd_reload():
-    subprocess.check_call(["/bin/systemctl", "daemon-reload"])
+    systemd.backend().reload()
 
 
 def container_exists(name):
@@ -39,17 +93,53 @@ def require_existing_container(f):
     return inner
 
 
+def service_properties(names, properties):
+    return systemd.backend().unit_properties(names, properties)
+
+
 def is_active(name):
-    return subprocess.call(['/bin/systemctl', 'is-active', name],
-                           stdout=subprocess.DEVNULL) == 0
+    return systemd.backend().is_active(name)
 
 
-def run_hooks(type, *args):
-    dirname = os.path.dirname(__file__)
-    hooks_dir = os.path.join(dirname, 'hooks', type)
-    dirs = [os.path.join(dirname, 'hooks', type),
-            os.path.join('/usr/lib/kostka/hooks', type),
-            os.path.join('/etc/kostka/hooks', type), ]
+_hooks = {}
+_hooks_lock = threading.Lock()
+
+
+def find_hooks(type):
+    '''Returns (path, options) pairs of the hooks of a type, in the order they run.
+
+       A hook can have a sidecar file called like the hook, with a .yml suffix:
+
+           parallel: true  # Run concurrently with adjacent parallel hooks
+           timeout: 30     # Kill the hook after 30 seconds
+    '''
+    with _hooks_lock:
+        if type not in _hooks:
+            _hooks[type] = [(path, hook_options(path)) for path in _hook_paths(type)]
+        return _hooks[type]
+
+
+def hook_options(path):
+    options = {'parallel': False, 'timeout': config['hook_timeout']}
+    try:
+        with open(path + '.yml') as f:
+            import yaml
+            options.update(yaml.safe_load(f) or {})
+    except FileNotFoundError:
+        pass
+    return options
+
+
+def _hook_paths(type):
+    if config['hook_dirs'] is not None:
+        dirs = [os.path.join(directory, type) for directory in config['hook_dirs']]
+        plugins = []
+    else:
+        dirname = os.path.dirname(__file__)
+        dirs = [os.path.join(dirname, 'hooks', type),
+                os.path.join('/usr/lib/kostka/hooks', type),
+                os.path.join('/etc/kostka/hooks', type), ]
+        plugins = entry_points('kostka')
     hooks = []
     for hooks_dir in dirs:
         if not os.path.exists(hooks_dir):
@@ -57,15 +147,52 @@ def run_hooks(type, *args):
 
         hooks += map(lambda f: os.path.join(hooks_dir, f), os.listdir(hooks_dir))
 
-    for ep in pkg_resources.iter_entry_points(group='kostka'):
-        path = os.path.join(ep.dist.location, ep.dist.key.replace('-', '_'), 'hooks', type)
+    for ep in plugins:
+        path = os.path.join(ep.dist_location, ep.dist_name.replace('-', '_'), 'hooks', type)
         if os.path.exists(path):
             hooks += map(lambda f: os.path.join(path, f), os.listdir(path))
 
-    for path in sorted(hooks):
-        if not os.path.isfile(path) or not os.access(path, os.X_OK):
-            print("NOT running hook {path} "
-                  "(`chmod +x {path}`?)".format(path=path), file=sys.stderr)
-            continue
+    return sorted(path for path in hooks if not path.endswith('.yml'))
+
+
+def run_hook(path, options, args):
+    if not os.path.isfile(path) or not os.access(path, os.X_OK):
+        print("NOT running hook {path} "
+              "(`chmod +x {path}`?)".format(path=path), file=sys.stderr)
+        return
 
-        subprocess.call([path] + list(args))
+    start = time.monotonic()
+    with trace.span(path, 'hook') as span:
+        # In a session of its own, so that a timeout also kills what the hook started
+        process = subprocess.Popen([path] + list(args), start_new_session=True)
+        try:
+            span['returncode'] = process.wait(timeout=options['timeout'] or None)
+        except subprocess.TimeoutExpired:
+            span['timeout'] = True
+            print("Hook {} killed after {} seconds".format(path, options['timeout']), file=sys.stderr)
+        finally:
+            if process.returncode is None:
+                os.killpg(process.pid, signal.SIGKILL)
+                process.wait()
+    if config['hook_timing']:
+        print("Hook {} took {:.2f}s".format(path, time.monotonic() - start), file=sys.stderr)
+
+
+def run_hooks(type, *args):
+    # Adjacent parallel hooks run together, the others one by one
+    group = []
+
+    def run_group():
+        if len(group) == 0:
+            return
+        with ThreadPoolExecutor(max_workers=max(len(group), 1)) as executor:
+            list(executor.map(lambda hook: run_hook(*hook, args), group))
+        group.clear()
+
+    for path, options in find_hooks(type):
+        if options['parallel']:
+            group.append((path, options))
+        else:
+            run_group()
+            run_hook(path, options, args)
+    run_group()
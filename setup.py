@@ -13,6 +13,10 @@ setup(
         'pyyaml',
         'tqdm',
     ],
+    extras_require={
+        # Talk to systemd over D-Bus instead of running systemctl
+        'dbus': ['jeepney'],
+    },
     entry_points={
         'console_scripts': 'kostka = kostka.kostka:cli',
         'kostka.create': [